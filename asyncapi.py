@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""
+Non-blocking views of lendingclub.API and p2ppicks.API. Every endpoint
+returns a Future right away and runs on a shared, bounded pool of
+worker threads, so many calls for many accounts can be in flight
+without a thread per call. The wrapped API objects keep sharing their
+connection pool and rate limiter.
+
+  lc = AsyncLendingClub(lendingclub.API(investor_id, api_key))
+  cash, loans = lc.available_cash(), lc.listed_loans()
+  wait([cash, loans])
+  print cash.result(), len(loans.result())
+"""
+
+import Queue
+import threading
+import time
+
+__all__ = ['Future', 'Executor', 'AsyncLendingClub', 'AsyncP2PPicks',
+           'CancelledError', 'TimeoutError', 'wait', 'default_executor',
+           'spawn']
+
+class CancelledError(Exception):
+  """The call was cancelled before it produced a result"""
+
+class TimeoutError(Exception):
+  """The result was not ready in time"""
+
+_PENDING, _RUNNING, _DONE, _CANCELLED = range(4)
+
+def _wait_for(cond, predicate, timeout):
+  """Wait on the held `cond` until predicate() is true or `timeout` passes"""
+  deadline = None if timeout is None else time.time() + timeout
+  while not predicate():
+    remaining = 1.0 if deadline is None else deadline - time.time()
+    if remaining <= 0:
+      return
+
+    # Bounded so KeyboardInterrupt is still delivered on Python 2
+    cond.wait(min(remaining, 1.0))
+
+class Future:
+  """
+  Result of a call that runs on an Executor
+
+  A call can be cancelled until it finishes. If it has not started it
+  never runs. A call already running can't be interrupted, but its
+  result is dropped and the future reports it was cancelled.
+  """
+  def __init__(self):
+    self._cond = threading.Condition(threading.Lock())
+    self._state = _PENDING
+    self._result = None
+    self._error = None
+    self._callbacks = []
+
+  def _complete(self, state, result=None, error=None):
+    """Move to a final state. Returns: False if already final."""
+    with self._cond:
+      if self._state in (_DONE, _CANCELLED):
+        return False
+      self._state = state
+      self._result = result
+      self._error = error
+      self._cond.notify_all()
+      callbacks, self._callbacks = self._callbacks, []
+
+    for fn in callbacks:
+      fn(self)
+    return True
+
+  def _start(self):
+    """Returns: False if the call was cancelled before it started"""
+    with self._cond:
+      if self._state != _PENDING:
+        return False
+      self._state = _RUNNING
+      return True
+
+  def cancel(self):
+    """Returns: True unless the call already finished"""
+    return self._complete(_CANCELLED)
+
+  def cancelled(self):
+    return self._state == _CANCELLED
+
+  def running(self):
+    return self._state == _RUNNING
+
+  def done(self):
+    """True once the call finished or was cancelled"""
+    return self._state in (_DONE, _CANCELLED)
+
+  def _wait(self, timeout):
+    with self._cond:
+      _wait_for(self._cond, self.done, timeout)
+      if not self.done():
+        raise TimeoutError()
+      if self._state == _CANCELLED:
+        raise CancelledError()
+
+  def result(self, timeout=None):
+    """
+    Block until the call finishes and return its value, or raise
+    what it raised. Raises CancelledError or TimeoutError.
+    """
+    self._wait(timeout)
+    if self._error is not None:
+      raise self._error
+    return self._result
+
+  def exception(self, timeout=None):
+    """Block until the call finishes and return what it raised, or None"""
+    self._wait(timeout)
+    return self._error
+
+  def add_done_callback(self, fn):
+    """Call fn(future) once done, on the thread that completes it"""
+    with self._cond:
+      if not self.done():
+        self._callbacks.append(fn)
+        return
+    fn(self)
+
+
+def _call(future, fn, args, kwargs):
+  """Run fn and complete `future` with its outcome"""
+  if not future._start():
+    return
+  try:
+    result = fn(*args, **kwargs)
+  except Exception as err:
+    future._complete(_DONE, error=err)
+  else:
+    future._complete(_DONE, result)
+
+
+class Executor:
+  """
+  Runs calls on a fixed set of daemon worker threads. Meant for short
+  api calls; long-running work that waits on other futures belongs on
+  its own thread (see spawn), or it can starve the workers.
+  """
+  def __init__(self, workers=16):
+    self.workers = workers
+    self._queue = Queue.Queue()
+    self._threads = []
+    for i in range(workers):
+      thread = threading.Thread(target=self._run, name='api-{}'.format(i))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _run(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      _call(*item)
+
+  def submit(self, fn, *args, **kwargs):
+    """Schedule fn(*args, **kwargs). Returns: Future"""
+    future = Future()
+    self._queue.put((future, fn, args, kwargs))
+    return future
+
+  def shutdown(self, wait=True):
+    """Stop the workers once queued calls are done"""
+    for _ in self._threads:
+      self._queue.put(None)
+    if wait:
+      for thread in self._threads:
+        thread.join()
+
+
+def wait(futures, timeout=None, first=False):
+  """
+  Wait for `futures` to finish
+
+  first: Return as soon as any future is done
+  Returns: (done, pending) lists of futures
+  """
+  futures = list(futures)
+  cond = threading.Condition(threading.Lock())
+
+  def notify(_):
+    with cond:
+      cond.notify_all()
+
+  for future in futures:
+    future.add_done_callback(notify)
+
+  def finished():
+    done = [f for f in futures if f.done()]
+    return bool(done) if first else len(done) == len(futures)
+
+  with cond:
+    _wait_for(cond, finished, timeout)
+
+  done = [f for f in futures if f.done()]
+  return done, [f for f in futures if not f.done()]
+
+def spawn(fn, *args, **kwargs):
+  """
+  Run fn(*args, **kwargs) on a new daemon thread, for long-running work
+  such as an account's order and reattempt loop
+  Returns: Future
+  """
+  future = Future()
+  thread = threading.Thread(target=_call, args=(future, fn, args, kwargs))
+  thread.daemon = True
+  thread.start()
+  return future
+
+_default_executor = None
+_default_lock = threading.Lock()
+
+def default_executor():
+  """Executor shared by every async API object of this process"""
+  global _default_executor
+  with _default_lock:
+    if _default_executor is None:
+      _default_executor = Executor()
+    return _default_executor
+
+
+class _AsyncAPI:
+  def __init__(self, api, executor=None):
+    """
+    api: The blocking API object to wrap
+    executor: Executor to run calls on. Defaults to default_executor().
+    """
+    self.api = api
+    self.executor = executor if executor is not None else default_executor()
+
+def _endpoint(name):
+  def call(self, *args, **kwargs):
+    return self.executor.submit(getattr(self.api, name), *args, **kwargs)
+  call.__name__ = name
+  call.__doc__ = "Future of the wrapped API's {}()".format(name)
+  return call
+
+class AsyncLendingClub(_AsyncAPI):
+  """Future-returning lendingclub.API"""
+
+class AsyncP2PPicks(_AsyncAPI):
+  """Future-returning p2ppicks.API"""
+
+for _name in ('available_cash', 'summary', 'notes_owned', 'portfolios_owned',
+              'create_portfolio', 'submit_order', 'listed_loans'):
+  setattr(AsyncLendingClub, _name, _endpoint(_name))
+
+for _name in ('picks', 'report', 'isActive', 'validate'):
+  setattr(AsyncP2PPicks, _name, _endpoint(_name))
+
+del _name
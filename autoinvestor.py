@@ -4,44 +4,161 @@
 Automated LendingClub investor using P2P-Picks for underwriting
 """
 
+import asyncapi
+import clocksync
+import criteria
 import lendingclub as lc
+import listings
+import loanbatch
+import metrics
 import p2ppicks as p2p
+import pickindex
+import portfolio
+import ratelimit
+import reattempt
+import reporting
+import scheduler
+import store
+import transport
 
 import datetime as dt
 import dateutil.parser as dateparser
 import json
 import logging
+import math
 import pprint
+import random
+import socket
 import time
 import urllib2
 from optparse import OptionParser
 
-__all__ = ['AutoInvestor']
+__all__ = ['Account', 'AutoInvestor']
+
+class _AccountLogger(logging.LoggerAdapter):
+  """Prefixes log messages with the account name"""
+  def process(self, msg, kwargs):
+    return '[{}] {}'.format(self.extra['account'], msg), kwargs
+
+
+class Account:
+  """
+  One LendingClub investor account and the P2P-Picks subscription
+  whose usage it reports
+
+  self.name: Account label, or None when it is the only account
+  self.lc: An instance of the LendingClub API with its own rate limiter
+  self.p2p: An instance of the P2P-Picks API
+  self.lc_portfolio: Name of the portfolio to assign notes to
+  self.lc_portfolio_id: Its id, or None if it doesn't exist
+  self.strategies: List of criteria.Strategy
+  self.logger: Logger that tags messages with the account name
+  self.label: Name used to label this account's metrics
+  self.notes: portfolio.NoteMirror of the notes the account owns
+  """
+  def __init__(self, name, lc_api, p2p_api, portfolio_id, strategies, logger):
+    self.name = name
+    self.label = name or 'default'
+    self.lc = lc_api
+    self.p2p = p2p_api
+    self.lc_portfolio = None
+    self.lc_portfolio_id = portfolio_id
+    self.strategies = strategies
+    self.notes = portfolio.NoteMirror(lc_api)
+    self.logger = logger if name is None \
+                  else _AccountLogger(logger, {'account': name})
+
 
 class AutoInvestor:
   """
   Auto investor for LendingClub using P2P-Picks to underwrite loans
   https://www.p2p-picks.com/
 
-  self.lc: An instance of the LendingClub API
-  self.p2p: An instance of the P2P-Picks API
+  self.accounts: List of Account to invest for
+  self.lc: LendingClub API of the first account, used to poll listings
+  self.p2p: P2P-Picks API of the first account, used to poll picks
   """
   #
   # Constants
   #
-  MIN_AMOUNT_PER_LOAN = 25.0
-
-  def __init__(self, secrets='secrets.json', logfile=None):
+  MIN_AMOUNT_PER_LOAN = criteria.MIN_AMOUNT_PER_LOAN
+
+  # Seconds to keep polling for an update
+  POLL_TIMEOUT = 30
+
+  # With --wait, seconds before the hour to start polling until the
+  # drop time has been learned, and how long before waking to refresh
+  # the server clock estimates
+  WAIT_LEAD = 5.0
+  CLOCK_REFRESH = 60.0
+
+  # With --wait, seconds before polling starts to warm up (see warm_up)
+  WARM_UP_LEAD = 3.0
+
+  # Most seconds a single poll request may take, so one stalled
+  # response doesn't use up the polling window
+  REQUEST_TIMEOUT = 5.0
+
+  # Most seconds an order may take, counted from its first request.
+  # Chunks are sent a rate-limit token apart, so this also caps how
+  # many chunks one order can send.
+  ORDER_TIMEOUT = 10.0
+
+  # Seconds to keep reattempting unfilled orders, and the first and
+  # largest delay between reattempts
+  REATTEMPT_WINDOW = 30 * 60
+  REATTEMPT_BACKOFF = (1.0, 60.0)
+
+  # Seconds to wait for queued reports at the end of a run
+  REPORT_FLUSH_TIMEOUT = 30
+
+  # Used when no strategies file is given (see criteria.py for the format)
+  DEFAULT_STRATEGIES = [{
+    "name": "default",
+    "filters": {
+      "intRate": {"min": 16.75},
+      "subGrade": {"max": "F2"}
+    },
+    "picks": {"top": ["5%"]},
+    "amount_per_loan": 50.0
+  }]
+
+  def __init__(self, secrets='secrets.json', logfile=None, strategies=None,
+               history=None, metrics_target=None, quiet=False,
+               report_spool=None, store_path=None):
     """
     secrets: path to a json file containing sensitive information
     logfile: path a logfile to append logging information
+    strategies: path to a json file with a list of investment strategies.
+                Defaults to DEFAULT_STRATEGIES.
+    history: path to a json file where past listing drop times are kept
+             to schedule polling. Without it nothing is learned between runs.
+    metrics_target: where to export timings after each run
+                    (see metrics.exporter_for). None disables export.
+    quiet: Don't print debug messages to the console
+    report_spool: path to a file keeping P2P-Picks reports until they
+                  are delivered. Unsent reports are resent on start.
+    store_path: SQLite file recording listings, picks, orders and notes
+                (see store.Store). None disables recording.
     {
       "lc_api_key": "a+akdkj3kdfjkp3239", // Lending Club api key
       "lc_investor_id": 93234531,         // Lending Club investor id
       "lc_portfolio": "MyPortfolio"     // Portfolio name to assign invested loans
       "p2p_key": "87C2FE2B4843AD",    // P2P-Picks API key
       "p2p_secret": "ASDKFAJKSDF",    // P2P-Picks API secret 
-      "p2p_sid": "384FBC34D3AB"      // P2P-Picks session ID
+      "p2p_sid": "384FBC34D3AB",     // P2P-Picks session ID
+      "p2p_products": ["profit-maximizer"], // Optional. Picks products
+                                            // to use, most preferred first
+      "lc_rate_limit_file": "/tmp/lc.bucket" // Optional. Share the rate
+                                             // limit with other processes
+    }
+    "lc_api_url" and "p2p_api_url" optionally point the APIs at
+    another server, such as simulator.py.
+    To invest for several accounts, put one object like the above
+    per account in an "accounts" list. Each account may also set
+    "name" and "strategies" (a strategies file for that account).
+    {
+      "accounts": [{...}, {...}]
     }
     """
     #
@@ -63,118 +180,270 @@ class AutoInvestor:
     # Log to console
     ch = logging.StreamHandler()
     ch.setFormatter(formatter)
-    ch.setLevel(logging.DEBUG)
+    ch.setLevel(logging.INFO if quiet else logging.DEBUG)
     self.logger.addHandler(ch)
 
+    # Phase timings and counters, exported after every run
+    self.metrics = metrics.Metrics()
+    self.metrics_exporter = None
+    if metrics_target is not None:
+      self.metrics_exporter = metrics.exporter_for(metrics_target)
+
     #
     # Initalize configurations
     # 
 
     with open(secrets) as f:
       secrets = json.load(f)
-      p2p_key = str(secrets['p2p_key'])
-      p2p_secret = str(secrets['p2p_secret'])
-      p2p_sid = str(secrets['p2p_sid'])
-      lc_investor_id = str(secrets['lc_investor_id'])
-      lc_api_key = str(secrets['lc_api_key'])
-
-      # Pass lending club secrets to lc.API
-      self.lc = lc.API(lc_investor_id, lc_api_key)
-
-      # Pass P2P-Picks secrets to p2p.API
-      self.p2p = p2p.API(p2p_key, p2p_secret, p2p_sid)
 
-      # Get portfolio ID from name if it exists
-      self.lc_portfolio_id = self.get_portfoio_id(secrets['lc_portfolio'])
-
-      if self.lc_portfolio_id is None:
-        self.logger.warning("Portfolio '{}' not found. Not using a portfolio"\
-                            .format(secrets['lc_portfolio']))
     #
     # Investment configurations
     #
-    # Minimum interest rate
-    self.MIN_INTEREST_RATE = 16.75
+    configs = self.DEFAULT_STRATEGIES
+    if strategies is not None:
+      with open(strategies) as f:
+        configs = json.load(f)
+
+    # Compiled once, then run against every listing
+    self.strategies = criteria.load_strategies(configs)
+
+    # Accounts are set up in parallel; each costs a few api calls
+    account_secrets = secrets.get('accounts', [secrets])
+    multiple = 'accounts' in secrets
+    self.accounts = self.for_each(
+      lambda info: self.load_account(info, multiple), account_secrets)
+    if None in self.accounts:
+      raise Exception("Could not set up every account")
+
+    # The first account polls listings and picks for all of them
+    primary = self.accounts[0]
+    self.lc = primary.lc
+    self.p2p = primary.p2p
+
+    # Picks of every product the first account subscribes to
+    self.pick_index = pickindex.PickIndex(self.p2p)
+    self.lc_portfolio_id = primary.lc_portfolio_id
+
+    # Reports and result logs are handled off the order path
+    self.reports = reporting.ReportQueue(report_spool, logger=self.logger)
+    for account in self.accounts:
+      self.reports.register(account.p2p)
+
+    # History of what each run saw, written on the report thread.
+    # Opened before any deferred call can use it.
+    self.store = store.Store(store_path) if store_path is not None else None
+
+    # Mirror owned notes in the background so exposure is known early
+    for account in self.accounts:
+      self.reports.defer(self.sync_notes, account)
+
+    # Only re-parse the listing when it changes
+    self.listings = listings.IncrementalListings(self.lc)
+
+    # Sample transport and rate limiter counters with every export
+    pools = dict((id(api.pool), api.pool)
+                 for a in self.accounts for api in (a.lc, a.p2p)).values()
+    self.metrics.add_source('http', lambda: dict(
+      (stat, sum(pool.stats[stat] for pool in pools))
+      for stat in ('requests', 'connects', 'retries', 'errors')))
+    self.metrics.add_source('ratelimit', lambda: {
+      'wait_seconds': sum(a.lc.rate_limiter.wait_time for a in self.accounts),
+      'calls': sum(a.lc.rate_limiter.calls for a in self.accounts),
+    }, gauge=True)
+    self.metrics.add_source('cache', lambda: {
+      'hits': sum(a.lc.cache.hits for a in self.accounts),
+      'misses': sum(a.lc.cache.misses for a in self.accounts),
+    })
+    self.metrics.add_source('clock', lambda: {
+      'lc_offset': self.lc.clock.offset(),
+      'lc_rtt': self.lc.clock.rtt or 0.0,
+      'p2p_offset': self.p2p.clock.offset(),
+      'p2p_rtt': self.p2p.clock.rtt or 0.0,
+    }, gauge=True)
+
+    # Learn when loans and picks update, in server time, to pace polling
+    self.schedules = {
+      'loans': scheduler.PollScheduler('loans', history,
+                                       clock=self.lc.clock.now),
+      'picks': scheduler.PollScheduler('picks', history,
+                                       clock=self.p2p.clock.now),
+    }
+
+  def load_account(self, info, named=False):
+    """
+    Set up one Account from its secrets
+
+    info: dict of account secrets (see __init__)
+    named: Label the account in logs
+    """
+    name = str(info.get('name', info['lc_investor_id'])) if named else None
+    lc_investor_id = str(info['lc_investor_id'])
+    lc_api_key = str(info['lc_api_key'])
+
+    # Share the rate limit with other processes using this api key
+    rate_limiter = None
+    if 'lc_rate_limit_file' in info:
+      rate_limiter = ratelimit.FileTokenBucket(
+        info['lc_rate_limit_file'],
+        rate=1.0 / lc.API.LC_RATE_LIMIT.total_seconds())
+
+    # Pass lending club secrets to lc.API
+    lc_api = lc.API(lc_investor_id, lc_api_key, rate_limiter=rate_limiter,
+                    api_url=info.get('lc_api_url'))
+
+    # Pass P2P-Picks secrets to p2p.API
+    p2p_api = p2p.API(str(info['p2p_key']), str(info['p2p_secret']),
+                      str(info['p2p_sid']), api_url=info.get('p2p_api_url'),
+                      products=info.get('p2p_products'))
+
+    strategies = self.strategies
+    if 'strategies' in info:
+      with open(info['strategies']) as f:
+        strategies = criteria.load_strategies(json.load(f))
+
+    account = Account(name, lc_api, p2p_api, None, strategies, self.logger)
+
+    # Get portfolio ID from name if it exists
+    account.lc_portfolio = info['lc_portfolio']
+    account.lc_portfolio_id = self.get_portfoio_id(info['lc_portfolio'], lc_api)
+
+    if account.lc_portfolio_id is None:
+      account.logger.warning("Portfolio '{}' not found. Not using a portfolio"\
+                             .format(info['lc_portfolio']))
+    return account
+
+  def for_each(self, fn, items):
+    """
+    Call `fn` on every item, one thread per item when there are
+    several. Calls can run long (an account's reattempts last up to
+    REATTEMPT_WINDOW), so they don't hold workers of the shared
+    executor, which stays free for api calls.
 
-    # Maximum interest rate
-    self.MAX_SUB_GRADE = 'F2'
+    Returns: list of results in the order of `items`. The result is
+             None for calls that raised; the error is logged.
+    """
+    def run(item):
+      try:
+        return fn(item)
+      except (KeyboardInterrupt, SystemExit):
+        raise
+      except Exception as err:
+        self.logger.error("{}: {}".format(type(err).__name__, err))
 
-    # Acceptable P2P-Picks grade
-    self.PICK_LEVEL = frozenset(['5%'])
+    if len(items) == 1:
+      return [run(items[0])]
 
-    # Desired amount per loan. Will use less if not enough available cash.
-    self.AMOUNT_PER_LOAN = 50.0
+    futures = [asyncapi.spawn(run, item) for item in items]
+    return [future.result() for future in futures]
 
-  def get_portfoio_id(self, name):
+  def get_portfoio_id(self, name, api=None, fresh=False):
     """
     Get portfolio id for portfolio with 'name'
     Returns None if timeout or no portfolio with that name
+
+    api: lendingclub.API of the account. Defaults to `self.lc`
+    fresh: Ask LendingClub even if the portfolios are cached
     """
+    api = api if api is not None else self.lc
     start = dt.datetime.now()
     while dt.datetime.now() - start < dt.timedelta(seconds=20):
       try:
         return next((int(p['portfolioId'])
-          for p in self.lc.portfolios_owned() 
+          for p in api.portfolios_owned(fresh) 
           if p['portfolioName'] == name), None)
       except urllib2.HTTPError as err:
         self.logger.debug("Portoflio error")
-        time.sleep(self.lc.LC_RATE_LIMIT.total_seconds())
+        time.sleep(api.LC_RATE_LIMIT.total_seconds())
 
     # Timeout
     self.logger.warning("Portoflio timeout")
     return None
 
-  def poll(self, fn):
+  def poll(self, fn, schedule=None):
     """
     Generator that polls a function
 
     fn: a function to poll. Will repoll if fn() returns `None`
+    schedule: scheduler.PollScheduler pacing the polls. Without one
+              every poll is made as soon as the rate limit allows.
     """
-    counter = 0
-    timeout = dt.datetime.now() + dt.timedelta(seconds=30)
-    while dt.datetime.now() < timeout:
-      counter += 1
-      try:
-        if not counter % 10:
-          self.logger.debug('Poll counter: {}'.format(counter))
-
-        value = fn()
-        if value is not None:
-          yield value
-
-      except urllib2.HTTPError as err:
-        self.logger.error("HTTPError: {}".format(err.code))
-        time.sleep(1)
-
-      except urllib2.URLError as err:
-        self.logger.error("URLError: {}".format(err.reason))
-        time.sleep(1)
+    if schedule is None:
+      schedule = scheduler.PollScheduler('poll')
+    schedule.start()
 
-      except (KeyboardInterrupt,SystemExit) as err:
-        # We're trying to quit
-        raise err
+    # Poll for 30 seconds, counted from the start of the fast window
+    now = schedule.clock
+    window_start = schedule.window_start() or 0
+    timeout = max(now(), window_start) + self.POLL_TIMEOUT
 
-      except Exception as err:
-        self.logger.critical("Other exception: {} {}".format(type(err), err))
+    try:
+      while now() < timeout:
+        delay = schedule.next_delay()
+        if delay > 0:
+          time.sleep(delay)
+
+        try:
+          with transport.deadline(min(timeout - now(),
+                                      self.REQUEST_TIMEOUT)):
+            value = fn()
+          schedule.polled()
+          if value is not None:
+            yield value
+
+        except urllib2.HTTPError as err:
+          self.logger.error("HTTPError: {}".format(err.code))
+          self.metrics.incr('poll_errors')
+          time.sleep(schedule.failed())
+
+        except urllib2.URLError as err:
+          self.logger.error("URLError: {}".format(err.reason))
+          self.metrics.incr('poll_errors')
+          time.sleep(schedule.failed())
+
+        except (KeyboardInterrupt,SystemExit) as err:
+          # We're trying to quit
+          raise err
+
+        except Exception as err:
+          self.logger.critical("Other exception: {} {}".format(type(err), err))
+          self.metrics.incr('poll_errors')
+          time.sleep(schedule.failed())
+
+    finally:
+      self.logger.info('Polled {} {} times'.format(schedule.name,
+                                                   schedule.requests))
+      self.metrics.incr('{}_polls'.format(schedule.name), schedule.requests)
 
     raise StopIteration("Polling timeout")
 
+  def current_picks(self):
+    """Every product's current picks in one list (see pickindex)"""
+    self.pick_index.poll()
+    return self.pick_index.picks()
+
   def wait_for_new_picks(self, start=None):
     """
-    Start polling for an update in listed loans
-    Must be called before picks update
+    Start polling for an update in P2P-Picks
+    Must be called before picks update. Returns once any product
+    updates, with every product's picks.
 
-    start: Time before picks update
+    start: dict of product -> time of its picks before the update
     """
+    index = self.pick_index
     if start is None:
-      _, start = self.p2p.picks()
+      index.poll()
+      start = dict(index.timestamps)
 
     self.logger.debug("Start polling picks")
 
-    for picks, timestamp in self.poll(self.p2p.picks):
-      if timestamp > start:
-        self.logger.info("New picks")
-        return picks
+    schedule = self.schedules['picks']
+    with self.metrics.span('picks_poll'):
+      for added in self.poll(index.poll, schedule):
+        if index.updated_since(start):
+          schedule.record_drop()
+          self.logger.info("New picks: {} loans added, {} picked in all"
+                           .format(len(added), len(index)))
+          return index.picks()
 
     self.logger.error("P2P-Picks polling timeout")
     raise Exception("P2P-Picks polling timeout")
@@ -186,196 +455,484 @@ class AutoInvestor:
 
     start: Time before loan update
     """
+    # Take the snapshot that later polls are compared against
+    self.listings.poll()
     if start is None:
-      start = dateparser.parse(self.lc.listed_loans()[0]['listD'])
+      start = max(dateparser.parse(l['listD']) for l in self.listings.loans)
 
     self.logger.debug("Start polling loans")
 
-    for loans in self.poll(self.lc.listed_loans):
-      timestamp = dateparser.parse(loans[0]['listD'])
+    # Returns None until loans are added, so `poll` keeps polling
+    new_loans = lambda: self.listings.poll() or None
+
+    schedule = self.schedules['loans']
+    with self.metrics.span('loans_poll'):
+      for loans in self.poll(new_loans, schedule):
+        timestamp = max(dateparser.parse(l['listD']) for l in loans)
 
-      if timestamp > start:
-        self.logger.info("New loans")
-        return loans
+        if timestamp > start:
+          # The listing was made before we saw it, which bounds the
+          # server clock more finely than Date headers
+          if timestamp.tzinfo is not None:
+            self.lc.clock.observe_after(clocksync.epoch(timestamp),
+                                        time.time())
+          schedule.record_drop()
+          self.logger.info("{} new loans".format(len(loans)))
+          return self.listings.loans
 
     self.logger.error("Listed loans polling timeout")
     raise Exception("Listed loans polling timeout")
 
-  def invest(self, order):
+  def wake_time(self):
+    """
+    Local time to start polling for the next drop. Both sources'
+    drops are timed on their servers' clocks, from the learned drop
+    times or WAIT_LEAD before the hour, less half a round trip.
+    """
+    wake = None
+    for name, api in (('loans', self.lc), ('picks', self.p2p)):
+      clock = api.clock
+
+      # A run started just after the hour is still for that drop
+      hour = math.ceil((clock.now() - self.POLL_TIMEOUT) / 3600.0) * 3600.0
+      first = self.schedules[name].first_poll(hour)
+      if first is None:
+        first = hour - self.WAIT_LEAD
+
+      local = clock.local(first) - (clock.rtt or 0.0) / 2.0
+      wake = local if wake is None else min(wake, local)
+    return wake
+
+  def sleep_until_drop(self, lead=0.0):
+    """
+    Sleep until `lead` seconds before `wake_time()`. Shortly before
+    waking the server clock estimates are refreshed, since clocks
+    drift during a long wait.
+    """
+    delay = self.wake_time() - lead - time.time()
+    if delay > self.CLOCK_REFRESH:
+      time.sleep(delay - self.CLOCK_REFRESH)
+      try:
+        self.lc.available_cash(fresh=True)
+        self.p2p.isActive(fresh=True)
+      except urllib2.URLError as err:
+        self.logger.warning("Clock refresh failed: {}".format(err))
+      delay = self.wake_time() - lead - time.time()
+
+    self.logger.debug('Sleep {:.3f} seconds (LendingClub clock {:+.3f}s)'
+                      .format(delay, self.lc.clock.offset()))
+    if delay > 0:
+      time.sleep(delay)
+
+  def warm_up(self, funded, refresh=False):
+    """
+    Get every funded account ready to order as soon as picks arrive:
+    open connections, sign the picks poll and pre-serialize orders.
+
+    funded: list of (account, available cash)
+    refresh: Also re-read cash and portfolio ids, which may have
+             changed during a long wait
+    Returns: list of (account, available cash) with enough cash to order
+    """
+    try:
+      self.p2p.warm_up()
+    except urllib2.URLError as err:
+      self.logger.warning("P2P-Picks warm up failed: {}".format(err.reason))
+
+    def prepare(item):
+      account, cash = item
+      if refresh:
+        portfolio_id = self.get_portfoio_id(account.lc_portfolio, account.lc,
+                                            fresh=True)
+        if portfolio_id is not None:
+          account.lc_portfolio_id = portfolio_id
+
+      # Every multiple of $25 a strategy can order per loan
+      largest = max(s.amount_per_loan for s in account.strategies)
+      amounts = [self.MIN_AMOUNT_PER_LOAN * i for i in
+                 range(1, int(largest // self.MIN_AMOUNT_PER_LOAN) + 1)]
+      return account, account.lc.warm_up(account.lc_portfolio_id, amounts,
+                                         fresh=refresh)
+
+    with self.metrics.span('warm_up'):
+      ready = self.for_each(prepare, funded)
+
+    # An account that failed to warm up still orders, just more slowly
+    ready = [warm or cold for warm, cold in zip(ready, funded)]
+    for account, cash in ready:
+      if cash < self.MIN_AMOUNT_PER_LOAN:
+        account.logger.info('Insufficient Cash: ${}'.format(cash))
+    return [(account, cash) for account, cash in ready
+            if cash >= self.MIN_AMOUNT_PER_LOAN]
+
+  def race_for_updates(self, old_picks_timestamp=None):
+    """
+    Poll LendingClub and P2P-Picks at the same time instead of one
+    after the other. Returns as soon as both sources have new data.
+    How long each source took is stored in `self.update_latency`.
+
+    old_picks_timestamp: Times of the picks before the update
+                         (see wait_for_new_picks)
+    Returns: tuple of (loans, picks)
+    """
+    start = time.time()
+    self.update_latency = {}
+
+    def timed(name, fn, *args):
+      try:
+        return fn(*args)
+      finally:
+        self.update_latency[name] = time.time() - start
+
+    # Each poll loop gets its own thread; the api calls they make
+    # (hedged requests, product fetches) use the shared executor
+    futures = {
+      'loans': asyncapi.spawn(timed, 'loans', self.wait_for_new_loans),
+      'picks': asyncapi.spawn(timed, 'picks', self.wait_for_new_picks,
+                              old_picks_timestamp),
+    }
+    asyncapi.wait(futures.values())
+
+    for name in ('loans', 'picks'):
+      self.logger.info('{} updated after {:.3f}s'
+                       .format(name.capitalize(), self.update_latency[name]))
+
+    loans = futures['loans'].result()
+
+    # Fall back to the current picks, as in the sequential path
+    if futures['picks'].exception() is not None:
+      picks = self.current_picks()
+    else:
+      picks = futures['picks'].result()
+
+    return loans, picks
+
+  def invest(self, order, account=None):
     """
-    Attept to invest in loans by id. Reports
+    Attept to invest in loans by id. Queues a report of
     successful investments to P2P-Picks.
 
     order: A lists of pairs (loan_id, amount) where 'amount'
             will be invested in the corresponding 'loan_id'.
             'amount' must be multiple of 25
+    account: Account to invest for. Defaults to the first account.
 
     Returns: JSON reponse from lending club
     """
+    account = account or self.accounts[0]
+    res = {}
     try:
-      # Submit order and report activity to P2P-Picks
-      res = self.lc.submit_order(order, self.lc_portfolio_id)
-      self.p2p.report(res)
+      # Submit order and queue the report to P2P-Picks
+      with self.metrics.span('submit_order', account=account.label):
+        with transport.deadline(self.ORDER_TIMEOUT):
+          res = account.lc.submit_order(order, account.lc_portfolio_id)
+      if self.store is not None:
+        self.reports.defer(self.store.add_order, res, account.label)
+      with self.metrics.span('p2p_report', account=account.label):
+        self.reports.report(account.p2p, res, self.pick_index.product)
       return res
     except (urllib2.HTTPError,urllib2.URLError) as e:
-      self.logger.error(e)
+      account.logger.error(e)
     except Exception as e:
-      self.logger.error(e)
+      account.logger.error(e)
       raise
 
     return res
 
-  def reattempt_invest(self, res):
+  def reattempt_invest(self, res, account=None, cash=None):
     """
-    Attept to reinvest in unsuccessful orders.
+    Attept to reinvest in unfilled and partially filled orders.
 
     res: Response from an investement attempt (self.invest())
+    account: Account that made the investment. Defaults to the first account.
+    cash: The account's cash after `res`, if known. Saves an api call.
     """
-    start = dt.datetime.now()
-    WAIT_TIME = dt.timedelta(minutes=30)
-
-    while dt.datetime.now() - start < WAIT_TIME:
-      # Check if we have enough cash
-      available_cash = self.lc.available_cash()
-      if available_cash < self.MIN_AMOUNT_PER_LOAN:
+    account = account or self.accounts[0]
+    with self.metrics.span('reattempt', account=account.label):
+      self._reattempt_invest(res, account, cash)
+
+  def _reattempt_invest(self, res, account, cash):
+    """Body of reattempt_invest"""
+    logger = account.logger
+    book = reattempt.OrderBook()
+    book.update(res)
+
+    if cash is None:
+      cash = account.lc.available_cash()
+
+    deadline = time.time() + self.REATTEMPT_WINDOW
+    delay = self.REATTEMPT_BACKOFF[0]
+    attempts = 0
+
+    while not book.done() and time.time() < deadline:
+      # Cash is tracked from the responses; only ask when it looks spent
+      if cash < self.MIN_AMOUNT_PER_LOAN:
+        cash = account.lc.available_cash(fresh=True)
+        if cash < self.MIN_AMOUNT_PER_LOAN:
+          break
+
+      order = book.next_order(cash)
+      if not order:
         break
 
-      # Calculate cash we can invest
-      investable_cash = available_cash - (available_cash % self.MIN_AMOUNT_PER_LOAN)
-
-      # Check if response has expected key
+      attempts += 1
+      res = self.invest(order, account)
       if 'orderConfirmations' not in res:
-        self.logger.debug("Key not found")
-        self.logger.debug(pprint.pformat(res))
-        return
-
-      # Loans we haven't successfully invested in
-      unfulfilled = [
-        (order['loanId'], min(float(order['requestedAmount']), investable_cash))
-          for order in res['orderConfirmations']
-          if not int(order['investedAmount'])
-      ]
-
-      # Make sure we have enough cash for all these orders
-      while sum(amt for order_id,amt in unfulfilled) > available_cash:
-        unfulfilled.pop()
-
-      # We invested in all of our picks
-      if not unfulfilled:
-        break
+        logger.debug("No order confirmations")
+        logger.debug('%s', metrics.Lazy(pprint.pformat, res))
+        logger.debug('%s', metrics.Lazy(pprint.pformat, order))
 
-      # Attempt another invest and update 'res' with its respons
-      res = self.invest(unfulfilled)
-
-      # Check if response has expected key
-      if 'orderConfirmations' not in res:
-        self.logger.debug("No order confirmations")
-        self.logger.debug(pprint.pformat(res))
-        self.logger.debug(pprint.pformat(unfulfilled))
-        return
+      invested = book.update(res)
+      cash -= invested
 
       # Log any succesful orders
-      for order in res['orderConfirmations']:
-        amount_invested = int(order['investedAmount'])
+      for confirmation in res.get('orderConfirmations', []):
+        amount_invested = int(confirmation['investedAmount'])
         if amount_invested:
-          self.logger.debug(pprint.pformat(order))
-          self.logger.info('Successful reattempt of ${} in loan {}'\
-                      .format(amount_invested, order['loanId']))
+          logger.debug('%s', metrics.Lazy(pprint.pformat, confirmation))
+          logger.info('Successful reattempt of ${} in loan {}'\
+                      .format(amount_invested, confirmation['loanId']))
+
+      if book.done():
+        break
 
-  def log_results(self, res, picks):
+      # Retry quickly while orders fill, back off while they don't
+      if invested:
+        delay = self.REATTEMPT_BACKOFF[0]
+      else:
+        delay = min(delay * 2, self.REATTEMPT_BACKOFF[1])
+      time.sleep(min(random.uniform(0.5, 1.0) * delay,
+                     max(0, deadline - time.time())))
+
+    requested, invested = book.totals()
+    logger.info('Reattempts: {} orders, ${:.0f} of ${:.0f} invested'
+                .format(attempts, invested, requested))
+
+  def log_results(self, res, picks, account=None):
     """
     Log details of investment response
 
     res: Return value of self.invest()
     picks: Return value of self.poll_for_update()
+    account: Account that made the investment
     """
+    logger = (account or self.accounts[0]).logger
+    logger.debug('%s', metrics.Lazy(pprint.pformat, picks))
+    logger.debug('%s', metrics.Lazy(pprint.pformat, res))
 
     # Create map of loan id's to grade
     id_to_grade = {int(pick['loan_id']): pick['grade'] for pick in picks}
 
     if 'orderConfirmations' not in res:
-      self.logger.error('Attempted to invest in an empty list of loans')
+      logger.error('Attempted to invest in an empty list of loans')
+      return
 
     for order in res['orderConfirmations']:
       loanID = int(order['loanId'])
       grade = id_to_grade[loanID]
-      self.logger.info('Invested ${} in grade {} loan {}'
+      logger.info('Invested ${} in grade {} loan {}'
                 .format(int(order['investedAmount']), grade, loanID))
 
 
-  def auto_invest(self, poll=False, wait=False):
+  def plan_orders(self, loans, picks, available_cash, account=None):
+    """
+    Run every strategy against the listing. Strategies run in order,
+    each spending from the cash the earlier ones left, and a loan
+    already ordered by one strategy is skipped by the rest.
+
+    loans: Listed loans, or a loanbatch.LoanBatch of them
+    picks: P2P-Picks picks
+    account: Account whose strategies to run. Defaults to the first account.
+    Returns: list of (loan_id, amount) pairs
+    """
+    account = account or self.accounts[0]
+    batch = loans if isinstance(loans, loanbatch.LoanBatch) \
+            else loanbatch.LoanBatch.from_loans(loans)
+
+    orders = []
+    for strategy, plan in criteria.plan_orders(account.strategies, batch,
+                                               picks, available_cash):
+      account.logger.info("Strategy '{}' matched {} loans"
+                          .format(strategy.name, len(plan)))
+      orders.extend(plan)
+
+    return orders
+
+  def auto_invest(self, poll=False, wait=False, race=False):
     """
     Main investment script for AutoInvestor. This should be run shortly
     before the hour. It will sleep until 5 seconds before the next hour,
     then poll both LendingClub and P2P-Picks for loan selection. Will
-    attempt to reinvest in unsuccessful loans. The min of AMOUNT_PER_LOAN
-    and the (available cash / number of valid picks) is invested per loan
+    attempt to reinvest in unsuccessful loans. Loans are selected and
+    sized by the strategies of each account in `self.accounts`
 
     poll: True if we want to poll for updated picks,
           False if we want to use the current picks
+    race: Poll loans and picks concurrently. Implies `poll`.
     """
-    # Exit if we don't have enough cash for 1 loan
-    available_cash = self.lc.available_cash()
-    if available_cash < self.MIN_AMOUNT_PER_LOAN:
-      msg = 'Insufficient Cash: ${}'.format(available_cash)
-      self.logger.info(msg)
+    # Reports that failed in an earlier run of this process get
+    # another try; a daemon has no next start to resend them
+    retried = self.reports.retry()
+    if retried:
+      self.logger.info("Resending {} P2P-Picks reports".format(retried))
+
+    try:
+      self._auto_invest(poll, wait, race)
+    finally:
+      if not self.reports.flush(self.REPORT_FLUSH_TIMEOUT):
+        self.logger.error("P2P-Picks reports still queued")
+      self.export_metrics()
+
+  def export_metrics(self):
+    """Export and reset the metrics of the last run"""
+    if self.metrics_exporter is not None:
+      try:
+        self.metrics_exporter.export(self.metrics.snapshot())
+      except (IOError, OSError, socket.error) as err:
+        self.logger.error("Metrics export failed: {}".format(err))
+    self.metrics.reset()
+
+  def _auto_invest(self, poll, wait, race):
+    """Body of auto_invest"""
+    # Skip accounts without enough cash for 1 loan
+    funded = []
+    with self.metrics.span('cash_check'):
+      cash = self.for_each(lambda a: a.lc.available_cash(), self.accounts)
+    for account, available_cash in zip(self.accounts, cash):
+      if available_cash is None:
+        continue
+      if available_cash < self.MIN_AMOUNT_PER_LOAN:
+        msg = 'Insufficient Cash: ${}'.format(available_cash)
+        account.logger.info(msg)
+        continue
+      funded.append((account, available_cash))
+
+    if not funded:
       return
 
-    # Store old picks time stamp to check for update
-    _, old_picks_timestamp = self.p2p.picks()
+    # Store old picks time stamps to check for update
+    self.pick_index.poll()
+    old_picks_timestamp = dict(self.pick_index.timestamps)
 
-    # Sleep until 5 seconds before the hour
+    # Sleep until polling should start for the drop, warming up on
+    # the way so the order is all that's left to do
+    if wait:
+      self.sleep_until_drop(self.WARM_UP_LEAD)
+    funded = self.warm_up(funded, refresh=wait)
+    if not funded:
+      return
     if wait:
-      now = dt.datetime.now()
-      sleep_time = now.replace(minute=59, second=55, microsecond=0) - now
-      self.logger.debug('Sleep {} seconds'.format(sleep_time.total_seconds()))
-      time.sleep(sleep_time.total_seconds())
+      self.sleep_until_drop()
 
-    # Get listed loans
-    loans = self.wait_for_new_loans() if poll else self.lc.listed_loans()
-    valid_loans = [l for l in loans
-                    if l['intRate'] >= self.MIN_INTEREST_RATE
-                    and l['subGrade'] <= self.MAX_SUB_GRADE]
+    # Get listed loans and picks
+    if race:
+      loans, picks = self.race_for_updates(old_picks_timestamp)
+    else:
+      loans = self.wait_for_new_loans() if poll else self.lc.listed_loans()
+
+      if poll:
+        try:
+          picks = self.wait_for_new_picks(old_picks_timestamp)
+        except:
+          picks = self.current_picks()
+      else:
+        picks = self.current_picks()
+
+    if self.store is not None:
+      self.reports.defer(self.store.add_listing, loans)
+      self.reports.defer(self.store.add_picks, picks)
+
+    # Every account orders from the same listing and picks at once.
+    # Only picked loans can be ordered, so the rest are left out.
+    batch = loanbatch.LoanBatch.from_loans(self.pick_index.join(loans))
+    self.for_each(
+      lambda item: self.invest_account(item[0], batch, picks, item[1]),
+      funded)
+
+  def invest_account(self, account, loans, picks, available_cash):
+    """
+    Order, report and reattempt matching loans for one account
 
-    # Prioritize high interest rate loans
-    valid_loans.sort(key=lambda x: x['intRate'], reverse=True)
+    loans: Listed loans, or a loanbatch.LoanBatch of them
+    picks: P2P-Picks picks
+    available_cash: The account's cash before ordering
+    """
+    with self.metrics.span('filter', account=account.label):
+      orders = self.plan_orders(loans, picks, available_cash, account)
 
-    if poll:
-      try:
-        picks = self.wait_for_new_picks(old_picks_timestamp)
-      except:
-        picks, _ = self.p2p.picks()
+    if not orders:
+      account.logger.info("No matching picks")
+      account.logger.debug('%s', metrics.Lazy(pprint.pformat, picks))
     else:
-      picks, _ = self.p2p.picks()
+      # Create order
+      res = self.invest(orders, account)
 
-    # Filter picks that match our criteria
-    valid_picks = frozenset(int(x['loan_id']) for x in picks 
-                                      if x['top'] in self.PICK_LEVEL)
+      # Log results on the report thread so reattempts start at once
+      self.reports.defer(self.log_results, res, picks, account)
 
-    top_picks = [l['id'] for l in valid_loans if l['id'] in valid_picks]
+      # Cash left after this order, counted from the confirmations
+      invested = sum(float(o['investedAmount'])
+                     for o in res.get('orderConfirmations', []))
+      self.reattempt_invest(res, account, available_cash - invested)
 
-    if not top_picks:
-      self.logger.info("No matching picks")
-      self.logger.debug(pprint.pformat(picks))
-    else:
-      # Calculate how much to invest per loan
-      amount = available_cash / len(top_picks)
-      amount = amount - (amount % self.MIN_AMOUNT_PER_LOAN)
-      amount = min(self.AMOUNT_PER_LOAN, amount)
-      amount = max(self.MIN_AMOUNT_PER_LOAN, amount)
+    # Log our final remaining ballance
+    account.logger.info('Done. ${:.2f} cash remaining'
+                        .format(account.lc.available_cash()))
 
-      # Create order
-      res = self.invest((lid, amount) for lid in top_picks)
+    # Refresh the note mirror after the run, off the order path
+    self.reports.defer(self.sync_notes, account)
 
-      # log results
-      self.logger.debug(pprint.pformat(picks))
-      self.logger.debug(pprint.pformat(res))
-      self.log_results(res, picks)
+  def sync_notes(self, account):
+    """
+    Update `account.notes` from LendingClub and save the notes
+    to the store if they changed
+    """
+    records = account.notes.fetch()
+    if records is None:
+      return
 
-      self.reattempt_invest(res)
+    added, changed, removed = account.notes.apply(records)
+    account.logger.debug('Notes: {} added, {} changed, {} removed'
+                         .format(len(added), len(changed), len(removed)))
+    account.logger.debug('%s', metrics.Lazy(pprint.pformat,
+                                            account.notes.exposure('grade')))
+
+    if self.store is not None:
+      self.store.add_notes(records, account.label)
 
-    # Log our final remaining ballance
-    self.logger.info('Done. ${:.2f} cash remaining'.format(self.lc.available_cash()))
+
+  def run_forever(self, poll=True, race=False, lead=5.0):
+    """
+    Daemon mode. Sleeps until `lead` seconds before each listing window
+    (scheduler.LISTING_HOURS, Pacific time) and runs auto_invest.
+    Secrets, accounts, portfolio ids and the connection pool are set up
+    once and reused for every window.
+
+    poll, race: Passed to auto_invest
+    lead: Seconds before the listing to start
+    """
+    last_listing = None
+    while True:
+      # Listing windows are on LendingClub's clock. A run that ends
+      # before its listing time must not start the same window again.
+      offset = self.lc.clock.offset()
+      now = dt.datetime.fromtimestamp(time.time() + offset,
+                                      scheduler.LISTING_TZ)
+      if last_listing is not None:
+        now = max(now, last_listing)
+      listing = scheduler.next_listing(now)
+      last_listing = listing
+      self.logger.info('Next listing at {}'.format(listing))
+      scheduler.sleep_until(listing - dt.timedelta(seconds=lead + offset))
+
+      try:
+        self.auto_invest(poll=poll, race=race)
+      except (KeyboardInterrupt, SystemExit):
+        raise
+      except Exception as err:
+        # Keep running for the next window
+        self.logger.critical("Listing at {} failed: {} {}"
+                             .format(listing, type(err), err))
 
 
 def main():
@@ -386,23 +943,70 @@ def main():
   parser.add_option('-p', '--poll', action='store_true', 
     dest='poll', default=False, help="Poll for updated picks")
 
-  # '--wait' indicates we should wait till next hour
+  # '--wait' indicates we should wait till the next drop
   parser.add_option('-w', '--wait', action='store_true', 
-    dest='wait', default=False, help="Wait until next hour")
+    dest='wait', default=False,
+    help="Wait until the next listing drop, timed on the servers' clocks")
+
+  # '--race' polls loans and picks at the same time
+  parser.add_option('-r', '--race', action='store_true',
+    dest='race', default=False, help="Poll loans and picks concurrently")
 
   # '--log' specifies a log file to which we should append logs
   parser.add_option('-l', '--log', action='store',
     dest='logfile', type='string', help="Log activity to file")
 
+  # '--strategies' specifies a json file of investment strategies
+  parser.add_option('-s', '--strategies', action='store',
+    dest='strategies', type='string', help="Investment strategies file")
+
+  # '--daemon' stays resident and invests at every listing window
+  parser.add_option('-d', '--daemon', action='store_true',
+    dest='daemon', default=False, help="Run at every listing window")
+
+  # '--history' specifies where to keep past listing drop times
+  parser.add_option('--history', action='store',
+    dest='history', type='string', help="Listing drop history file")
+
+  # '--metrics' specifies where to export phase timings
+  parser.add_option('-m', '--metrics', action='store',
+    dest='metrics', type='string',
+    help="Export timings to a file (.prom for Prometheus) or udp://host:port")
+
+  # '--quiet' hides debug output on the console
+  parser.add_option('-q', '--quiet', action='store_true',
+    dest='quiet', default=False, help="Don't print debug messages")
+
+  # '--spool' keeps P2P-Picks reports until they are delivered
+  parser.add_option('--spool', action='store',
+    dest='spool', type='string', default='p2p-reports.spool',
+    help="File of undelivered P2P-Picks reports")
+
+  # '--store' records listings, picks, orders and notes
+  parser.add_option('--store', action='store',
+    dest='store', type='string',
+    help="SQLite file to record listings, picks, orders and notes in")
+
   # Collect options
   options, args = parser.parse_args()
 
   # Set API's with account information
-  investor = AutoInvestor(logfile=options.logfile)
+  investor = AutoInvestor(logfile=options.logfile,
+                          strategies=options.strategies,
+                          history=options.history,
+                          metrics_target=options.metrics,
+                          quiet=options.quiet,
+                          report_spool=options.spool,
+                          store_path=options.store)
+
+  if options.daemon:
+    investor.run_forever(poll=options.poll or options.race, race=options.race)
+    return
 
   # Poll for new picks is '--poll' option provided
   # Otherwise, use current picks
-  investor.auto_invest(poll=options.poll, wait=options.wait)
+  investor.auto_invest(poll=options.poll, wait=options.wait,
+                       race=options.race)
 
 if __name__ == '__main__':
   main()
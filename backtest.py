@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+Offline backtests. Replays listings and picks recorded by store.Store
+through the same selection and sizing code the investor runs live
+(criteria.plan_orders), for many strategy sets in parallel.
+
+Sweep file: a base strategy and values to try for some of its keys.
+Dotted keys reach into nested dicts; every combination is tested.
+{
+  "base": {"name": "sweep", "picks": {"top": ["5%"]}, "amount_per_loan": 25},
+  "grid": {
+    "filters.intRate.min": [12, 14, 16, 18],
+    "filters.subGrade.max": ["D5", "E5", "F5"],
+    "amount_per_loan": [25, 50]
+  }
+}
+A plain list of strategy lists is also accepted and run as given.
+"""
+
+import copy
+import itertools
+import json
+import multiprocessing
+from optparse import OptionParser
+
+import criteria
+import loanbatch
+import store
+
+__all__ = ['load_runs', 'expand_grid', 'evaluate', 'run_backtest']
+
+# Rough annual loss rate by grade, used to estimate returns
+EXPECTED_LOSS = {'A': 0.015, 'B': 0.03, 'C': 0.05, 'D': 0.07,
+                 'E': 0.09, 'F': 0.11, 'G': 0.13}
+
+# LendingClub's service fee on payments, as a share of the rate
+SERVICE_FEE = 0.01
+
+# Picks count for a listing if taken within this many seconds after it
+MAX_PICKS_GAP = 600.0
+
+def load_runs(path):
+  """
+  Pair every recorded listing with the picks taken after it
+  Returns: list of (loanbatch.LoanBatch, picks, {loan id: (rate, grade)})
+  """
+  db = store.Store(path)
+  try:
+    listings = db.snapshots('listing')
+    picks = db.snapshots('picks')
+
+    runs = []
+    for snapshot, taken in listings:
+      after = [(pid, ptaken) for pid, ptaken in picks
+               if pid > snapshot and 0 <= ptaken - taken <= MAX_PICKS_GAP]
+      if not after:
+        continue
+      loans = db.snapshot(snapshot)
+      terms = dict((loan['id'], (loan['intRate'] / 100.0, loan['subGrade'][0]))
+                   for loan in loans)
+      runs.append((loanbatch.LoanBatch.from_loans(loans),
+                   db.snapshot(after[0][0]), terms))
+    return runs
+  finally:
+    db.close()
+
+def _set(config, path, value):
+  keys = path.split('.')
+  for key in keys[:-1]:
+    config = config.setdefault(key, {})
+  config[keys[-1]] = value
+
+def expand_grid(sweep):
+  """
+  Returns: list of strategy lists, one per combination in `sweep`
+           (see module docstring)
+  """
+  if isinstance(sweep, list):
+    return sweep
+
+  grid = sorted(sweep.get('grid', {}).items())
+  keys = [key for key, _ in grid]
+  sets = []
+  for values in itertools.product(*[values for _, values in grid]):
+    config = copy.deepcopy(sweep['base'])
+    for key, value in zip(keys, values):
+      _set(config, key, value)
+    sets.append([config])
+  return sets
+
+def evaluate(strategies, runs, cash):
+  """
+  Replay `runs` with `strategies`, starting every run with `cash`
+  Returns: dict of totals (see run_backtest)
+  """
+  result = {'runs': len(runs), 'matched': 0, 'loans': 0, 'deployed': 0.0,
+            'rate': 0.0, 'returns': 0.0}
+
+  for batch, picks, terms in runs:
+    for strategy, plan in criteria.plan_orders(strategies, batch, picks, cash):
+      result['matched'] += len(strategy.matching_picks(picks))
+      for loan_id, amount in plan:
+        rate, grade = terms[loan_id]
+        loss = EXPECTED_LOSS[grade]
+        result['loans'] += 1
+        result['deployed'] += amount
+        result['rate'] += amount * rate
+        result['returns'] += amount * (rate * (1 - SERVICE_FEE) - loss)
+
+  if result['deployed']:
+    result['rate'] /= result['deployed']
+    result['yield'] = result['returns'] / result['deployed']
+  else:
+    result['yield'] = 0.0
+  return result
+
+# Replayed runs, loaded once per worker process
+_runs = None
+
+def _init_worker(path):
+  global _runs
+  _runs = load_runs(path)
+
+def _evaluate(args):
+  configs, cash = args
+  return evaluate(criteria.load_strategies(configs), _runs, cash)
+
+def run_backtest(path, sets, cash=1000.0, processes=None):
+  """
+  Backtest every strategy list in `sets` against the store at `path`
+
+  processes: Worker processes. Defaults to one per core.
+  Returns: list of (strategy list, result) pairs in the order of `sets`.
+           A result has the number of 'runs', picks 'matched', 'loans'
+           ordered, cash 'deployed', its average interest 'rate', and
+           estimated annual 'returns' and 'yield' after fees and losses.
+  """
+  # Compile every set first so a bad config fails before forking
+  for configs in sets:
+    criteria.load_strategies(configs)
+
+  pool = multiprocessing.Pool(processes, _init_worker, (path,))
+  try:
+    chunksize = max(1, len(sets) // (4 * (processes or multiprocessing.cpu_count())))
+    results = pool.map(_evaluate, [(configs, cash) for configs in sets],
+                       chunksize)
+  finally:
+    pool.close()
+    pool.join()
+  return zip(sets, results)
+
+def main():
+  parser = OptionParser(usage="%prog [options] store.db sweep.json")
+  parser.add_option('--cash', type='float', dest='cash', default=1000.0,
+    help="Cash available at every listing")
+  parser.add_option('-j', '--jobs', type='int', dest='jobs',
+    help="Worker processes (default: one per core)")
+  parser.add_option('-n', '--top', type='int', dest='top', default=20,
+    help="Number of best strategy sets to show")
+  options, args = parser.parse_args()
+  if len(args) != 2:
+    parser.error("expected a store and a sweep file")
+
+  with open(args[1]) as f:
+    sets = expand_grid(json.load(f))
+
+  results = run_backtest(args[0], sets, options.cash, options.jobs)
+  results.sort(key=lambda item: item[1]['returns'], reverse=True)
+
+  print "returns  yield   deployed  loans  matched  rate    strategies"
+  for configs, res in results[:options.top]:
+    print "{:>7.2f}  {:>5.2%}  {:>8.2f}  {:>5}  {:>7}  {:>5.2%}  {}".format(
+      res['returns'], res['yield'], res['deployed'], res['loans'],
+      res['matched'], res['rate'],
+      json.dumps(configs, sort_keys=True, separators=(',',':')))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""
+End-to-end latency benchmark. Runs `AutoInvestor.auto_invest` against
+simulator.py for several listing drops and reports drop-to-order
+latency, requests used and investor CPU time per run.
+"""
+
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+from optparse import OptionParser
+
+from autoinvestor import AutoInvestor
+
+__all__ = ['percentile', 'run_benchmark']
+
+# Orders everything P2P-Picks selects, so every drop produces an order
+BENCHMARK_STRATEGIES = [{"name": "benchmark", "amount_per_loan": 25.0}]
+
+def percentile(values, pct):
+  """Nearest-rank percentile of `values`"""
+  ordered = sorted(values)
+  if not ordered:
+    return None
+  rank = int(round(pct / 100.0 * len(ordered) + 0.5)) - 1
+  return ordered[max(0, min(rank, len(ordered) - 1))]
+
+def _free_port():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+def _control(base, action, query='', post=True):
+  url = '{}/_sim/{}{}'.format(base, action, query)
+  return json.load(urllib2.urlopen(url, data='' if post else None))
+
+def _start_simulator(port, options):
+  """Run the simulator in its own process so its CPU isn't counted"""
+  here = os.path.dirname(os.path.abspath(__file__))
+  proc = subprocess.Popen([sys.executable, os.path.join(here, 'simulator.py'),
+    '--port', str(port),
+    '--latency', str(options.latency),
+    '--error-rate', str(options.error_rate),
+    '--picks-delay', str(options.picks_delay),
+    '--cash', '1000000'], stdout=open(os.devnull, 'w'))
+
+  base = 'http://127.0.0.1:{}'.format(port)
+  for _ in range(100):
+    try:
+      _control(base, 'stats', post=False)
+      return proc, base
+    except urllib2.URLError:
+      time.sleep(0.05)
+  proc.kill()
+  raise Exception("Simulator did not start")
+
+def run_benchmark(options):
+  """
+  Returns: list of per-run dicts with 'latency' (seconds from drop to
+           the first order reaching the server, or None if no order),
+           'requests' and 'cpu' (investor seconds)
+  """
+  proc, base = _start_simulator(_free_port(), options)
+  workdir = tempfile.mkdtemp()
+  try:
+    secrets = os.path.join(workdir, 'secrets.json')
+    with open(secrets, 'w') as f:
+      json.dump({
+        "lc_api_key": "benchmark", "lc_investor_id": 1,
+        "lc_portfolio": "Simulated",
+        "p2p_key": "key", "p2p_secret": "secret", "p2p_sid": "sid",
+        "lc_api_url": base + '/api/investor/v1',
+        "p2p_api_url": base + '/api/v1',
+      }, f)
+
+    strategies = os.path.join(workdir, 'strategies.json')
+    with open(strategies, 'w') as f:
+      json.dump(BENCHMARK_STRATEGIES, f)
+
+    investor = AutoInvestor(secrets=secrets, strategies=strategies)
+    if not options.verbose:
+      investor.logger.setLevel(logging.WARNING)
+
+    results = []
+    for run in range(options.runs):
+      _control(base, 'reset')
+      drop = time.time() + options.lead
+      _control(base, 'drop', '?at={}'.format(drop))
+
+      cpu = sum(os.times()[:2])
+      investor.auto_invest(poll=True, race=options.race)
+      cpu = sum(os.times()[:2]) - cpu
+
+      stats = _control(base, 'stats', post=False)
+      orders = stats['orders']
+      results.append({
+        'latency': orders[0]['time'] - drop if orders else None,
+        'requests': sum(stats['requests'].values()),
+        'throttled': stats['throttled'],
+        'cpu': cpu,
+      })
+    return results
+  finally:
+    proc.kill()
+    shutil.rmtree(workdir)
+
+def main():
+  parser = OptionParser()
+  parser.add_option('-n', '--runs', type='int', dest='runs', default=5,
+    help="Number of listing drops to simulate")
+  parser.add_option('--lead', type='float', dest='lead', default=3.0,
+    help="Seconds between starting a run and the drop")
+  parser.add_option('--latency', type='float', dest='latency', default=0.02,
+    help="Mean simulated network latency in seconds")
+  parser.add_option('--error-rate', type='float', dest='error_rate',
+    default=0.0, help="Fraction of requests failing with a 500")
+  parser.add_option('--picks-delay', type='float', dest='picks_delay',
+    default=1.0, help="Seconds from listing drop to picks update")
+  parser.add_option('-r', '--race', action='store_true', dest='race',
+    default=False, help="Poll loans and picks concurrently")
+  parser.add_option('-v', '--verbose', action='store_true', dest='verbose',
+    default=False, help="Show investor logs")
+  options, args = parser.parse_args()
+
+  results = run_benchmark(options)
+
+  print "run  latency(ms)  requests  throttled  cpu(ms)"
+  for i, res in enumerate(results):
+    latency = '{:.1f}'.format(res['latency'] * 1000) \
+              if res['latency'] is not None else '-'
+    print "{:>3}  {:>11}  {:>8}  {:>9}  {:>7.1f}".format(
+      i, latency, res['requests'], res['throttled'], res['cpu'] * 1000)
+
+  latencies = [r['latency'] * 1000 for r in results if r['latency'] is not None]
+  if latencies:
+    print "\ndrop-to-order p50 {:.1f}ms  p99 {:.1f}ms".format(
+      percentile(latencies, 50), percentile(latencies, 99))
+  print "requests/run {:.1f}  cpu/run {:.1f}ms".format(
+    sum(r['requests'] for r in results) / float(len(results)),
+    sum(r['cpu'] for r in results) / len(results) * 1000)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+Small thread-safe cache with per-entry time-to-live, used to avoid
+spending rate-limited api calls on values that rarely change.
+"""
+
+import threading
+
+import ratelimit
+
+__all__ = ['TTLCache']
+
+class TTLCache:
+  """
+  Maps keys to values that expire `ttl` seconds after they were stored
+
+  self.hits: Number of lookups answered from the cache
+  self.misses: Number of lookups that had to call through
+  """
+  def __init__(self, clock=ratelimit.monotonic):
+    """
+    clock: Function returning the current time in seconds
+    """
+    self.clock = clock
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+
+    # key -> (expiry time, value)
+    self._entries = {}
+
+  def get(self, key, fn, ttl, fresh=False):
+    """
+    Return the cached value of `key`, or store and return fn()
+    fresh: Ignore the cached value and call fn()
+    """
+    if not fresh:
+      with self._lock:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > self.clock():
+          self.hits += 1
+          return entry[1]
+        self.misses += 1
+
+    # Called outside the lock so a slow request doesn't block others
+    value = fn()
+    self.set(key, value, ttl)
+    return value
+
+  def set(self, key, value, ttl):
+    with self._lock:
+      self._entries[key] = (self.clock() + ttl, value)
+
+  def update(self, key, fn):
+    """
+    Replace the cached value of `key` with fn(value), keeping its
+    expiry. Does nothing if `key` is not cached.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] > self.clock():
+        self._entries[key] = (entry[0], fn(entry[1]))
+
+  def invalidate(self, key=None):
+    """Forget `key`, or everything if `key` is None"""
+    with self._lock:
+      if key is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(key, None)
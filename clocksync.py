@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+Estimates of how far a server's clock is from ours, so polling can be
+timed to the server's listing drop rather than the local clock.
+
+HTTP Date headers only have one second resolution, but each response
+bounds the offset: the server stamped it sometime between sending the
+request and receiving the response. Intersecting these bounds over
+many requests narrows the offset to well below a second. Timestamps
+with finer resolution, such as a new listing's listD, add further
+bounds.
+"""
+
+import calendar
+import collections
+import email.utils
+import threading
+import time
+
+__all__ = ['ClockSync', 'parse_date', 'epoch']
+
+def parse_date(value):
+  """Epoch seconds of an HTTP Date header, or None if it is malformed"""
+  parsed = email.utils.parsedate_tz(value or '')
+  if parsed is None:
+    return None
+  return email.utils.mktime_tz(parsed)
+
+def epoch(when):
+  """Epoch seconds of an aware datetime, keeping its fractions"""
+  return calendar.timegm(when.utctimetuple()) + when.microsecond / 1e6
+
+class ClockSync:
+  """
+  Offset of one server's clock from the local clock
+
+  self.rtt: Shortest recent request round-trip time in seconds, or None
+  """
+  def __init__(self, max_age=6 * 3600.0, max_samples=256, clock=time.time):
+    """
+    max_age: Seconds a sample is trusted for, since clocks drift
+    max_samples: Most samples kept
+    clock: Function returning the local time in seconds
+    """
+    self.max_age = max_age
+    self.clock = clock
+    self.rtt = None
+    self._lock = threading.Lock()
+
+    # (local time, lowest offset, highest offset), oldest first
+    self._samples = collections.deque(maxlen=max_samples)
+    self._rtts = collections.deque(maxlen=32)
+
+  def observe(self, sent, received, server_time, resolution=1.0):
+    """
+    Learn from a response stamped with `server_time`
+
+    sent: Local time the request was sent
+    received: Local time the response arrived
+    resolution: Seconds the server time was truncated to
+    """
+    with self._lock:
+      self._samples.append((received, server_time - received,
+                            server_time + resolution - sent))
+      self._rtts.append(received - sent)
+      self.rtt = min(self._rtts)
+
+  def observe_after(self, server_time, received):
+    """
+    Learn from an event that happened at `server_time`, seen at local
+    time `received`. Only bounds the offset from below.
+    """
+    with self._lock:
+      self._samples.append((received, server_time - received, float('inf')))
+
+  def bounds(self):
+    """
+    Range the offset lies in, or None without samples. If the server
+    clock stepped, older samples disagree and are ignored.
+    """
+    oldest = self.clock() - self.max_age
+    low, high = float('-inf'), float('inf')
+    with self._lock:
+      for taken, sample_low, sample_high in reversed(self._samples):
+        if taken < oldest:
+          break
+        if sample_low > high or sample_high < low:
+          break
+        low, high = max(low, sample_low), min(high, sample_high)
+    if low == float('-inf'):
+      return None
+    return low, high
+
+  def offset(self):
+    """Seconds the server clock is ahead of ours, or 0.0 if unknown"""
+    bounds = self.bounds()
+    if bounds is None:
+      return 0.0
+    low, high = bounds
+    return low if high == float('inf') else (low + high) / 2.0
+
+  def error(self):
+    """Most seconds `offset()` can be off by, or None if unbounded"""
+    bounds = self.bounds()
+    if bounds is None or bounds[1] == float('inf'):
+      return None
+    return (bounds[1] - bounds[0]) / 2.0
+
+  def now(self):
+    """Estimated current server time"""
+    return self.clock() + self.offset()
+
+  def local(self, server_time):
+    """Local time at which the server clock reads `server_time`"""
+    return server_time - self.offset()
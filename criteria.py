@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""
+Declarative investment criteria. A strategy is described by a plain
+dict (usually loaded from JSON) and compiled once into a `Strategy`
+that selects and sizes orders for every listing.
+
+Example strategy:
+{
+  "name": "high-yield",
+  "filters": {
+    "intRate": {"min": 16.75},        // ranges: "min" and/or "max"
+    "subGrade": {"max": "F2"},        // sub-grades compare by rank
+    "term": {"in": [36, 60]},         // sets of allowed values
+    "purpose": {"in": ["debt_consolidation", "credit_card"]}
+  },
+  "picks": {"top": ["5%"]},           // P2P-Picks fields to match,
+                                      // e.g. "product" or "grade"
+  "amount_per_loan": 50.0,
+  "max_loans": 20,                    // Optional
+  "cash_fraction": 1.0                // Optional share of available cash
+}
+"""
+
+import loanbatch
+
+__all__ = ['Strategy', 'load_strategies', 'plan_orders']
+
+# Minimum LendingClub note size
+MIN_AMOUNT_PER_LOAN = 25.0
+
+# Filters LoanBatch can evaluate on columns: field -> {op: where() argument}
+_COLUMN_FILTERS = {
+  'intRate': {'min': 'min_rate', 'max': 'max_rate'},
+  'subGrade': {'min': 'min_sub_grade', 'max': 'max_sub_grade'},
+  'term': {'in': 'terms'},
+}
+
+def _compile_predicate(filters, name):
+  """
+  Compile {field: {op: value}} into a single function of a dict.
+  The test is generated as one expression so each call is a single
+  Python frame rather than a loop over filters.
+  """
+  terms = []
+  consts = {}
+  for field, ops in sorted(filters.items()):
+    for op, value in sorted(ops.items()):
+      const = 'c{}'.format(len(consts))
+      subject = 'd[{!r}]'.format(field)
+
+      # Sub-grades compare by rank, not as strings
+      if field == 'subGrade' and op in ('min', 'max'):
+        value = loanbatch.sub_grade_rank(value)
+        subject = 'rank({})'.format(subject)
+
+      if op == 'min':
+        terms.append('{} >= {}'.format(subject, const))
+      elif op == 'max':
+        terms.append('{} <= {}'.format(subject, const))
+      elif op == 'in':
+        value = frozenset(value)
+        terms.append('{} in {}'.format(subject, const))
+      else:
+        raise ValueError("Unknown operator '{}' for '{}'".format(op, field))
+      consts[const] = value
+
+  if not terms:
+    return None
+
+  consts['rank'] = loanbatch.sub_grade_rank
+  source = 'lambda d: ' + ' and '.join(terms)
+  return eval(compile(source, '<{}>'.format(name), 'eval'), consts)
+
+
+class Strategy:
+  """
+  A compiled strategy
+
+  self.name: Strategy name
+  self.amount_per_loan: Desired amount per loan
+  self.max_loans: Maximum number of loans to order, or None
+  self.cash_fraction: Share of available cash this strategy may use
+  """
+  def __init__(self, config):
+    """
+    config: Strategy description (see module docstring)
+    """
+    self.name = config.get('name', 'default')
+    self.amount_per_loan = float(config.get('amount_per_loan', 50.0))
+    self.max_loans = config.get('max_loans')
+    self.cash_fraction = float(config.get('cash_fraction', 1.0))
+
+    if self.amount_per_loan < MIN_AMOUNT_PER_LOAN:
+      raise ValueError("Strategy '{}': amount_per_loan below ${}"
+                       .format(self.name, MIN_AMOUNT_PER_LOAN))
+
+    # Split loan filters into column filters and a compiled remainder
+    self._where = {}
+    rest = {}
+    for field, ops in config.get('filters', {}).items():
+      for op, value in ops.items():
+        arg = _COLUMN_FILTERS.get(field, {}).get(op)
+        if arg is not None:
+          self._where[arg] = value
+        else:
+          rest.setdefault(field, {})[op] = value
+
+    self._loan_predicate = _compile_predicate(rest, self.name)
+    self._pick_predicate = _compile_predicate(
+      dict((field, {'in': values})
+           for field, values in config.get('picks', {}).items()),
+      self.name + ' picks')
+
+    # Last picks list seen by matching_picks and its result
+    self._matched = (None, None)
+
+  def matching_picks(self, picks):
+    """Return frozenset of loan ids of the P2P-Picks this strategy accepts"""
+    # Accounts and backtests ask again for the same picks list; the
+    # (picks, ids) pair is swapped in whole so threads can share it
+    cached_picks, cached_ids = self._matched
+    if cached_picks is picks:
+      return cached_ids
+
+    accept = self._pick_predicate
+    ids = frozenset(int(p['loan_id']) for p in picks
+                    if accept is None or accept(p))
+    self._matched = (picks, ids)
+    return ids
+
+  def select(self, batch, picks):
+    """
+    batch: loanbatch.LoanBatch of listed loans
+    picks: List of picks from p2ppicks.API.picks
+    Returns: list of matching loan ids, highest interest rate first
+    """
+    # Join on picks first since it is the most selective step
+    matched = batch.join(self.matching_picks(picks)).where(**self._where)
+
+    if self._loan_predicate is not None:
+      matched = matched.compress(map(self._loan_predicate, matched))
+
+    loan_ids = list(matched.sort_by_rate().ids)
+    if self.max_loans is not None:
+      loan_ids = loan_ids[:self.max_loans]
+    return loan_ids
+
+  def budget(self, available_cash, remaining_cash):
+    """
+    Cash this strategy may spend given the account's `available_cash`
+    and the `remaining_cash` left by strategies that ran before it
+    """
+    return min(remaining_cash, available_cash * self.cash_fraction)
+
+  def allocate(self, loan_ids, cash):
+    """
+    Split `cash` across `loan_ids`. Each loan gets the smaller of
+    `amount_per_loan` and an even share, in multiples of $25.
+
+    Returns: list of (loan_id, amount) pairs
+    """
+    if not loan_ids:
+      return []
+
+    amount = cash / len(loan_ids)
+    amount = amount - (amount % MIN_AMOUNT_PER_LOAN)
+    amount = min(self.amount_per_loan, amount)
+    amount = max(MIN_AMOUNT_PER_LOAN, amount)
+    return [(lid, amount) for lid in loan_ids]
+
+
+def load_strategies(configs):
+  """
+  Compile a list of strategy descriptions
+  Returns: list of Strategy
+  """
+  strategies = [Strategy(config) for config in configs]
+
+  names = [s.name for s in strategies]
+  if len(set(names)) != len(names):
+    raise ValueError('Strategy names must be unique')
+  return strategies
+
+
+def plan_orders(strategies, batch, picks, available_cash):
+  """
+  Run `strategies` against a listing. Strategies run in order, each
+  spending from the cash the earlier ones left, and a loan already
+  ordered by one strategy is skipped by the rest.
+
+  batch: loanbatch.LoanBatch of listed loans
+  picks: List of picks from p2ppicks.API.picks
+  Returns: list of (strategy, [(loan_id, amount)]) for every strategy
+           that ordered something
+  """
+  plans = []
+  ordered = set()
+  remaining_cash = available_cash
+
+  for strategy in strategies:
+    budget = strategy.budget(available_cash, remaining_cash)
+    if budget < MIN_AMOUNT_PER_LOAN:
+      continue
+
+    loan_ids = [lid for lid in strategy.select(batch, picks)
+                if lid not in ordered]
+    plan = strategy.allocate(loan_ids, budget)
+    if plan:
+      plans.append((strategy, plan))
+
+    ordered.update(loan_ids)
+    remaining_cash -= sum(amount for _, amount in plan)
+
+  return plans
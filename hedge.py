@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+Hedged requests for idempotent reads. If a response takes longer
+than a learned percentile of recent latencies, a second identical
+request is sent and whichever answers first is used. This trims the
+latency tail at drop time for the price of an occasional extra call.
+"""
+
+import collections
+import threading
+import time
+
+import asyncapi
+import transport
+
+__all__ = ['Hedger']
+
+class Hedger:
+  """
+  Sends a backup request when the first one is slow
+
+  self.hedged: Number of backup requests sent
+  self.won: Number of backup requests that answered first
+  """
+  def __init__(self, percentile=90, history=100, min_samples=10,
+               min_delay=0.02, executor=None):
+    """
+    percentile: Latency percentile after which a backup is sent
+    history: Number of recent latencies to learn from
+    min_samples: Latencies to collect before hedging at all
+    min_delay: Shortest wait before a backup, in seconds
+    executor: asyncapi.Executor to send on. Defaults to the shared one.
+    """
+    self.percentile = percentile
+    self.min_samples = min_samples
+    self.min_delay = min_delay
+    self.executor = executor
+
+    self.hedged = 0
+    self.won = 0
+
+    self._lock = threading.Lock()
+    self._latencies = collections.deque(maxlen=history)
+
+  def delay(self):
+    """Seconds to wait for a response before hedging, or None"""
+    with self._lock:
+      if len(self._latencies) < self.min_samples:
+        return None
+      ordered = sorted(self._latencies)
+    rank = int(self.percentile / 100.0 * (len(ordered) - 1))
+    return max(self.min_delay, ordered[rank])
+
+  def _timed(self, fn, when):
+    """Run fn under the caller's deadline and record its latency"""
+    start = time.time()
+    if when is None:
+      result = fn()
+    else:
+      with transport.deadline(at=when):
+        result = fn()
+    with self._lock:
+      self._latencies.append(time.time() - start)
+    return result
+
+  def call(self, fn, spare=None):
+    """
+    Return fn(), sending a second fn() if the first is slow
+
+    fn: Idempotent request. Must not take a rate-limit token itself.
+    spare: Function returning True if the budget allows another
+           request right now, e.g. a non-blocking token take. Without
+           it a backup is always allowed.
+    """
+    delay = self.delay()
+    when = transport.current_deadline()
+    if delay is None:
+      return self._timed(fn, when)
+
+    executor = self.executor or asyncapi.default_executor()
+    first = executor.submit(self._timed, fn, when)
+    done, _ = asyncapi.wait([first], timeout=delay)
+    if done or (spare is not None and not spare()):
+      return first.result()
+
+    self.hedged += 1
+    second = executor.submit(self._timed, fn, when)
+    pending = [first, second]
+    while pending:
+      done, pending = asyncapi.wait(pending, first=True)
+      for future in done:
+        if future.exception() is None:
+          # The loser's response is still read, so its connection can
+          # go back to the pool
+          if future is second:
+            self.won += 1
+          return future.result()
+
+    # Both failed; report the first request's error
+    return first.result()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Incremental decoding of a JSON array of objects nested under a
+top-level key, e.g. the "loans" array of the LendingClub listing.
+Items are decoded as soon as their closing brace arrives.
+"""
+
+import json
+import re
+
+__all__ = ['ArrayItemParser']
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+class ArrayItemParser:
+  """
+  Feed raw JSON text in arbitrary chunks and get back every complete
+  array item seen so far. Items must be JSON objects.
+
+  self.done: True once the closing bracket of the array has been seen
+  """
+  def __init__(self, key, fields=None):
+    """
+    key: Top-level key holding the array
+    fields: Optional collection of keys to keep from each item.
+            Other keys are dropped while decoding.
+    """
+    self._start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+
+    hook = None
+    if fields is not None:
+      fields = frozenset(fields)
+      hook = lambda pairs: dict((k, v) for k, v in pairs if k in fields)
+    self._decoder = json.JSONDecoder(object_pairs_hook=hook)
+
+    # Unconsumed text, starting at the next item or separator
+    self._buf = ''
+    self._in_array = False
+    self.done = False
+
+  def feed(self, data):
+    """
+    data: Next chunk of the JSON document
+    Returns: list of items completed by this chunk
+    """
+    if self.done:
+      return []
+
+    buf = self._buf + data
+    pos = 0
+
+    if not self._in_array:
+      match = self._start.search(buf)
+      if match is None:
+        # Keep enough text to match a key split across chunks
+        self._buf = buf[-(len(self._start.pattern) + 64):]
+        return []
+      self._in_array = True
+      pos = match.end()
+
+    items = []
+    while True:
+      pos = _SEPARATORS.match(buf, pos).end()
+      if pos >= len(buf):
+        break
+      if buf[pos] == ']':
+        self.done = True
+        break
+      if buf[pos] != '{':
+        raise ValueError('Expected object at array position {}'.format(len(items)))
+
+      # An item cut off by the end of the chunk fails to decode;
+      # keep it and retry once more text arrives
+      try:
+        item, pos = self._decoder.raw_decode(buf, pos)
+      except ValueError:
+        break
+      items.append(item)
+
+    self._buf = buf[pos:]
+    return items
+
+  def close(self):
+    """
+    Raise ValueError if the document ended inside the array.
+    A document without the key simply had no items.
+    """
+    if self._in_array and not self.done:
+      raise ValueError('JSON array ended unexpectedly')
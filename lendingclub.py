@@ -8,8 +8,13 @@ of API calls is handled automatically.
 import datetime as dt
 import json
 import pprint
-import time
-import urllib2
+import threading
+
+import cache
+import hedge
+import jsonstream
+import ratelimit
+import transport
 
 __all__ = ['API']
 
@@ -18,86 +23,184 @@ class API:
   Provides and interface to the LendingClub REST API
   https://www.lendingclub.com/developers/lc-api.action
   """
-  # Url for the loans resource
-  _LOAN_URL = "https://api.lendingclub.com/api/investor/v1/loans/listing"
+  # Root of all api resources
+  API_URL = "https://api.lendingclub.com/api/investor/v1"
 
   # Rate limit for the api.
   # All api calls share this ratelimit, as
   # specified in LendingClub's guidelines.
   LC_RATE_LIMIT = dt.timedelta(seconds=1.0)
 
-  def __init__(self, investor_id, api_key):
+  # Most loans sent in one order request (see submit_order)
+  ORDER_CHUNK_SIZE = 20
+
+  # Seconds slow-changing resources are cached for. Cash is kept
+  # current between fetches from order confirmations.
+  CACHE_TTL = {
+    'availablecash': 300.0,
+    'summary': 60.0,
+    'portfolios': 3600.0,
+  }
+
+  def __init__(self, investor_id, api_key, pool=None, rate_limiter=None,
+               api_url=None):
     """
     investor_id: LendingClub investor investor_id
     api_key: LendingClub api key
+    pool: transport.ConnectionPool to send requests on.
+          Defaults to the pool shared by all API objects.
+    rate_limiter: A ratelimit.TokenBucket or FileTokenBucket. Share one
+                  between API objects that use the same api key.
+                  Defaults to one call per LC_RATE_LIMIT.
+    api_url: Root url of the api. Defaults to API_URL.
     """
     self.lc_investor_id = investor_id
     self.lc_api_key = api_key
 
+    # Keep-alive connections to api.lendingclub.com
+    self.pool = pool if pool is not None else transport.default_pool()
+
+    # Timing of the most recent request (see transport.Response)
+    self.last_timing = None
+
     # Url for all account actions
-    self._base_url ='https://api.lendingclub.com/api/investor/v1/accounts/{}/{}'\
-                    .format(investor_id, '{}')
+    api_url = api_url or API.API_URL
+    self._base_url = (api_url + '/accounts/{}/{}').format(investor_id, '{}')
+
+    # Url for the loans resource
+    self._loan_url = api_url + '/loans/listing'
+
+    # Estimated offset of LendingClub's clock, learned from responses
+    self.clock = self.pool.clock(api_url)
 
-    # Last time an api call was made (for rate limiting)
+    # All api calls made through this object share this limiter
+    if rate_limiter is None:
+      rate_limiter = ratelimit.TokenBucket(
+        rate=1.0 / self.LC_RATE_LIMIT.total_seconds())
+    self.rate_limiter = rate_limiter
+
+    # Last time an api call was made
     self.last_api_call = dt.datetime(year=2000,month=1,day=1)
 
-  def _wait_for_timeout(self):
+    # Cached account resources (see CACHE_TTL)
+    self.cache = cache.TTLCache()
+
+    # Backup requests for slow listing polls
+    self.hedger = hedge.Hedger()
+
+    # Orders are sent with these headers and bodies pieced together
+    # from pre-serialized templates (see prepare_orders)
+    self._order_headers = {
+      'Authorization': self.lc_api_key,
+      'Accept': 'application/json',
+      'Content-type': 'application/json',
+    }
+    self._order_templates = {}
+
+  def _wait_for_timeout(self, priority=ratelimit.PRIORITY_NORMAL):
     """
-    Wait until `LC_RATE_LIMIT` time has passed since the last API call
-    Time of last call stored in `last_api_call`
+    Wait for a token from `rate_limiter`. Callers with a lower
+    `priority` value are served first.
     This should be called right before the rate-limited action
     """
-    sleep_time = self.last_api_call - dt.datetime.now() + self.LC_RATE_LIMIT
-    if sleep_time > dt.timedelta(0):
-      time.sleep(sleep_time.total_seconds())
+    self.rate_limiter.acquire(priority)
 
     # Update last call
     self.last_api_call = dt.datetime.now()
 
-  def _request_resource(self, resource, data=None):
+  def _request_resource(self, resource, data=None,
+                        priority=ratelimit.PRIORITY_NORMAL):
     """Return json response to resource as dict
-    All api actions share a rate limit specified
-    in LC_RATE_LIMIT.
+    All api actions share the rate limit of `rate_limiter`.
 
     data -- json payload for the request
+    priority -- rate limiter priority (see ratelimit.PRIORITY_*)
     """
-    req = urllib2.Request(self._base_url.format(resource))
-    req.add_header('Authorization', self.lc_api_key)
+    headers = {'Authorization': self.lc_api_key}
+    body = None
 
     if data is not None:
-      req.add_header('Accept', 'application/json')
-      req.add_header('Content-type', 'application/json')
-      req.add_data(json.dumps(data, separators=(',',':')))
+      headers['Accept'] = 'application/json'
+      headers['Content-type'] = 'application/json'
+      body = json.dumps(data, separators=(',',':'))
+
+    return json.loads(self._send(self._base_url.format(resource),
+                                 body, headers, priority).body)
 
+  def _send(self, url, body, headers, priority=ratelimit.PRIORITY_NORMAL,
+            limited=True):
+    """
+    Rate limit and send a request on the shared connection pool
+    limited -- False if the caller already took the token
+    Returns: transport.Response
+    """
     # Rate limit all api calls
-    self._wait_for_timeout()
+    if limited:
+      self._wait_for_timeout(priority)
 
-    return json.load(urllib2.urlopen(req))
+    res = self.pool.request('GET' if body is None else 'POST',
+                            url, body, headers)
+    self.last_timing = res.timing
+    return res
 
-  def available_cash(self):
+  def _cached(self, resource, fresh, priority=ratelimit.PRIORITY_NORMAL):
+    """Return `resource` from the cache, or request and cache it"""
+    return self.cache.get(resource,
+      lambda: self._request_resource(resource, priority=priority),
+      self.CACHE_TTL[resource], fresh)
+
+  def available_cash(self, fresh=False):
     """Get the availble cash in your account
     Returns: Float value of remaining cache
+    fresh -- Ask LendingClub even if a cached value is current.
+             Cached cash already has this object's orders deducted.
     """
-    data = self._request_resource("availablecash")
+    data = self._cached("availablecash", fresh)
     return data['availableCash']
 
-  def summary(self):
+  def _spent(self, res):
+    """Deduct the cash invested by an order response from the cache"""
+    invested = sum(float(o['investedAmount'])
+                   for o in res.get('orderConfirmations', []))
+    if invested:
+      self.cache.update("availablecash", lambda data: dict(data,
+        availableCash=data['availableCash'] - invested))
+    # The summary's totals are stale now
+    self.cache.invalidate("summary")
+
+  def summary(self, fresh=False):
     """
     Returns: Dict of account info
+    fresh -- Ask LendingClub even if a cached value is current
     """
-    return self._request_resource("summary")
+    return self._cached("summary", fresh, ratelimit.PRIORITY_LOW)
 
   def notes_owned(self, detailed=False):
     """
     Returns: list of notes owned 
     if 'datailed' is true, more information is provided for each loan
     """
-    data = self._request_resource("detailednotes" if detailed else "notes")
+    data = self._request_resource("detailednotes" if detailed else "notes",
+                                  priority=ratelimit.PRIORITY_LOW)
     return data['myNotes']
 
-  def portfolios_owned(self):
-    """get list of portfolios owned"""
-    data = self._request_resource("portfolios")
+  def notes_owned_response(self, detailed=False, headers=None):
+    """
+    Get the raw notes response without parsing it
+    headers -- Extra request headers, e.g. If-None-Match
+    Returns: transport.Response. Status is 304 if the notes are unchanged.
+    """
+    req_headers = {'Authorization': self.lc_api_key}
+    req_headers.update(headers or {})
+    return self._send(
+      self._base_url.format("detailednotes" if detailed else "notes"),
+      None, req_headers, ratelimit.PRIORITY_LOW)
+
+  def portfolios_owned(self, fresh=False):
+    """get list of portfolios owned
+    fresh -- Ask LendingClub even if a cached value is current
+    """
+    data = self._cached("portfolios", fresh, ratelimit.PRIORITY_LOW)
     return data['myPortfolios']
 
   def create_portfolio(self, name, desc=""):
@@ -107,46 +210,202 @@ class API:
       "portfolioName": name,
       "portfolioDescription": desc
     }
-    return self._request_resource("portfolios", data=payload)
+    res = self._request_resource("portfolios", data=payload)
+    self.cache.invalidate("portfolios")
+    return res
 
-  def submit_order(self, orders, portfolioId=None):
+  def submit_order(self, orders, portfolioId=None, chunk_size=None):
     """
     submit and order for some loans
     orders: A lists of pairs (loan_id, amount) where 'amount'
             will be invested in the corresponding 'loan_id'.
-            'amount' will be rounded down to a multiple of 25
+            'amount' will be rounded down to a multiple of 25.
+            Loans should be ranked, best first.
     portfolioId -- The portfolio to assign notes to
+    chunk_size -- Most loans per request. Defaults to ORDER_CHUNK_SIZE.
+
+    Larger orders are split into chunks sent in rank order, each as
+    soon as the rate limit allows and without waiting for the previous
+    response. Confirmations are merged into one response, with the
+    first chunk's orderInstructId. Loans of a chunk whose request
+    never reached LendingClub (transport.RequestNotSent) are confirmed
+    with nothing invested and executionStatus ['REQUEST_FAILED'], so
+    they can be reattempted. Loans of a chunk that failed any other
+    way, e.g. timed out, may have been bought and are left out of the
+    response. If every chunk fails the first error is raised.
     """
-    payload = {}
-    payload['aid'] = int(self.lc_investor_id)
-    payload['orders']= [{
-      "loanId": int(lid),
-      "requestedAmount": float(amount),
-      "portfolioId": int(portfolioId)
-    } if portfolioId is not None else {
-      "loanId": int(lid),
-      "requestedAmount": float(amount)
-    } for lid, amount in orders]
+    orders = list(orders)
+    chunk_size = chunk_size or self.ORDER_CHUNK_SIZE
+    url = self._base_url.format('orders')
+    if len(orders) <= chunk_size:
+      res = json.loads(self._send(url, self._order_body(orders, portfolioId),
+        self._order_headers, ratelimit.PRIORITY_ORDER).body)
+      self._spent(res)
+      return res
+
+    chunks = [orders[i:i + chunk_size]
+              for i in range(0, len(orders), chunk_size)]
+    results = [None] * len(chunks)
+
+    # Deadlines are per thread; carry the caller's over to the chunks
+    when = transport.current_deadline()
+
+    def send(i, body):
+      try:
+        if when is None:
+          res = self.pool.request('POST', url, body, self._order_headers)
+        else:
+          with transport.deadline(at=when):
+            res = self.pool.request('POST', url, body, self._order_headers)
+        self.last_timing = res.timing
+        results[i] = json.loads(res.body)
+      except Exception as err:
+        results[i] = err
+
+    # Tokens are taken here, in rank order; requests overlap in threads
+    threads = []
+    for i, chunk in enumerate(chunks):
+      body = self._order_body(chunk, portfolioId)
+      self._wait_for_timeout(ratelimit.PRIORITY_ORDER)
+      thread = threading.Thread(target=send, args=(i, body))
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
 
-    return self._request_resource('orders', data=payload)
+    for thread in threads:
+      thread.join()
+
+    res = self._merge_orders(chunks, results)
+    self._spent(res)
+    if any(isinstance(r, Exception) and
+           not isinstance(r, transport.RequestNotSent) for r in results):
+      # What those chunks spent is unknown
+      self.cache.invalidate("availablecash")
+    return res
+
+  def prepare_orders(self, portfolioId=None, amounts=()):
+    """
+    Serialize the fixed parts of order requests ahead of time, so
+    submit_order only splices loan ids into them
+    portfolioId -- The portfolio orders will assign notes to
+    amounts -- Amounts per loan that orders will use. Others are
+               serialized on first use.
+    """
+    template = self._order_templates.get(portfolioId)
+    if template is None:
+      prefix = '{{"aid":{},"orders":['.format(int(self.lc_investor_id))
+      template = self._order_templates[portfolioId] = (prefix, {})
+    for amount in amounts:
+      self._order_suffix(template[1], portfolioId, amount)
+    return template
+
+  def _order_suffix(self, suffixes, portfolioId, amount):
+    """Everything of a loan's order after its id, for `amount`"""
+    suffix = suffixes.get(amount)
+    if suffix is None:
+      suffix = ',"requestedAmount":{}'.format(json.dumps(float(amount)))
+      if portfolioId is not None:
+        suffix += ',"portfolioId":{}'.format(int(portfolioId))
+      suffix = suffixes[amount] = suffix + '}'
+    return suffix
+
+  def _order_body(self, orders, portfolioId):
+    """Json body of an order, the same as json.dumps of the payload"""
+    prefix, suffixes = self.prepare_orders(portfolioId)
+    return prefix + ','.join(['{"loanId":%d%s' % (int(lid),
+      suffixes.get(amount) or self._order_suffix(suffixes, portfolioId, amount))
+      for lid, amount in orders]) + ']}'
+
+  def warm_up(self, portfolioId=None, amounts=(), connections=2, fresh=True):
+    """
+    Get ready to order right before a listing: open connections to
+    the api, prepare order templates and refresh the cached cash
+    portfolioId, amounts -- See prepare_orders
+    connections -- Connections to have open
+    fresh -- Ask LendingClub for the cash even if the cached value is
+             current
+    Returns: available cash
+    """
+    self.pool.warm(self._loan_url, connections)
+    self.prepare_orders(portfolioId, amounts)
+    return self.available_cash(fresh)
+
+  def _merge_orders(self, chunks, results):
+    """Combine the responses of chunked orders (see submit_order)"""
+    errors = [res for res in results if isinstance(res, Exception)]
+    if len(errors) == len(results):
+      raise errors[0]
+
+    merged = {'orderInstructId': None, 'orderConfirmations': []}
+    for chunk, res in zip(chunks, results):
+      if isinstance(res, transport.RequestNotSent):
+        merged['orderConfirmations'].extend({
+          'loanId': int(lid),
+          'requestedAmount': float(amount),
+          'investedAmount': 0.0,
+          'executionStatus': ['REQUEST_FAILED'],
+        } for lid, amount in chunk)
+        continue
+      if isinstance(res, Exception):
+        # The server may have filled it; ordering again could buy twice
+        continue
+
+      if merged['orderInstructId'] is None:
+        merged['orderInstructId'] = res.get('orderInstructId')
+      merged['orderConfirmations'].extend(res.get('orderConfirmations', []))
+    return merged
 
   def listed_loans(self, showAll=False):
     """
     Get currently listed loans
     showAll -- Get all listed loans instead of just the most recent
     """
-    # Build request
-    req = urllib2.Request(
-      (API._LOAN_URL + "?showAll=true") if showAll else API._LOAN_URL
-    )
-    req.add_header('Authorization', self.lc_api_key)
+    data = json.loads(self.listed_loans_response(showAll).body)
+    return data['loans'] if 'loans' in data else None
 
-    # Ratelimit call
-    self._wait_for_timeout()
+  def stream_listed_loans(self, showAll=True, predicate=None, fields=None):
+    """
+    Generator over currently listed loans, yielding each loan as soon
+    as it has been downloaded instead of after the whole listing.
+    showAll -- Get all listed loans instead of just the most recent
+    predicate -- Optional function of a loan. Loans it rejects are
+                 dropped immediately.
+    fields -- Optional collection of loan keys to keep. Others are
+              discarded while decoding.
+    """
+    url = (self._loan_url + "?showAll=true") if showAll else self._loan_url
 
-    # Query endpoint
-    data = json.load(urllib2.urlopen(req))
-    return data['loans'] if 'loans' in data else None
+    self._wait_for_timeout(ratelimit.PRIORITY_HIGH)
+    res = self.pool.stream('GET', url, None,
+                           {'Authorization': self.lc_api_key})
+
+    parser = jsonstream.ArrayItemParser('loans', fields)
+    for chunk in res:
+      for loan in parser.feed(chunk):
+        if predicate is None or predicate(loan):
+          yield loan
+    parser.close()
+
+    self.last_timing = res.timing
+
+  def listed_loans_response(self, showAll=False, headers=None):
+    """
+    Get the raw listing response without parsing it
+    showAll -- Get all listed loans instead of just the most recent
+    headers -- Extra request headers, e.g. If-None-Match
+    Returns: transport.Response. Status is 304 if the listing is unchanged.
+    """
+    url = (self._loan_url + "?showAll=true") if showAll else self._loan_url
+
+    req_headers = {'Authorization': self.lc_api_key}
+    req_headers.update(headers or {})
+
+    # Query endpoint. A slow response is hedged only if the rate limit
+    # has a token to spare right away.
+    self._wait_for_timeout(ratelimit.PRIORITY_HIGH)
+    return self.hedger.call(
+      lambda: self._send(url, None, req_headers, limited=False),
+      spare=lambda: self.rate_limiter.try_acquire(ratelimit.PRIORITY_HIGH))
 
 
 def main():
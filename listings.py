@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""
+Incremental client for the LendingClub loan listing. Only reports
+loans added since the previous poll, and avoids parsing the listing
+at all when it has not changed.
+"""
+
+import json
+
+import transport
+
+__all__ = ['IncrementalListings']
+
+class IncrementalListings:
+  """
+  Tracks a snapshot of listed loans between polls
+
+  self.loans: Loans in the latest snapshot, in listing order
+  self.unchanged: Number of polls skipped because nothing changed
+  """
+  def __init__(self, api, showAll=False):
+    """
+    api: lendingclub.API instance
+    showAll: Track all listed loans instead of just the most recent
+    """
+    self.api = api
+    self.showAll = showAll
+
+    self.loans = None
+    self.unchanged = 0
+
+    # asOfDate changes on every response, so only the body from the
+    # "loans" key onward is compared
+    self._fetch = transport.ConditionalFetch(
+      lambda headers: api.listed_loans_response(self.showAll, headers),
+      key='loans')
+
+    # Ids of the loans in the current snapshot
+    self._ids = frozenset()
+
+  def poll(self):
+    """
+    Fetch the listing and update the snapshot
+    Returns: list of loans not in the previous snapshot. The first
+             poll returns every listed loan.
+    """
+    res = self._fetch.fetch()
+    if res is None:
+      self.unchanged += 1
+      return []
+
+    loans = json.loads(res.body).get('loans') or []
+    new_loans = [l for l in loans if l['id'] not in self._ids]
+
+    self.loans = loans
+    self._ids = frozenset(l['id'] for l in loans)
+    return new_loans
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+Columnar representation of listed loans for fast screening.
+Key loan fields are held in typed arrays, and filters, sorts and
+joins run as C-level map/compress passes over whole columns.
+Columns are only extracted from the loan dicts when first used.
+"""
+
+import itertools
+import operator
+from array import array
+from functools import partial
+
+__all__ = ['LoanBatch', 'SUB_GRADES', 'sub_grade_rank']
+
+# LendingClub sub-grades from best to worst
+SUB_GRADES = tuple('{}{}'.format(grade, n)
+                   for grade in 'ABCDEFG' for n in range(1, 6))
+
+_SUB_GRADE_RANK = dict((sg, rank) for rank, sg in enumerate(SUB_GRADES))
+
+# Column name -> (array typecode, conversion from the listing value)
+_COLUMNS = {
+  'id': ('l', None),
+  'intRate': ('d', None),
+  'subGrade': ('b', _SUB_GRADE_RANK.__getitem__),
+  'term': ('h', None),
+}
+
+def sub_grade_rank(sub_grade):
+  """Return the position of `sub_grade` in SUB_GRADES. A1 is 0."""
+  return _SUB_GRADE_RANK[sub_grade]
+
+
+class LoanBatch:
+  """
+  Listed loans stored column by column. Filters and sorts don't copy
+  the columns; they return a batch sharing them with a new selection
+  of rows. Screen with the most selective step first (usually `join`)
+  so later steps only touch the rows that survive it.
+
+  self.loans: The source listing
+  self.index: Selected row positions in the source listing, in order
+  """
+  def __init__(self, loans, columns, index, full=False):
+    """
+    full: True if `index` is every row of `loans` in source order
+    """
+    self.loans = loans
+    self._columns = columns
+    self.index = index
+    self._full = full
+
+  @classmethod
+  def from_loans(cls, loans):
+    """
+    Build a batch from the list returned by lendingclub.API.listed_loans
+    """
+    loans = loans or []
+    return cls(loans, {}, range(len(loans)), full=True)
+
+  def __len__(self):
+    return len(self.index)
+
+  def __iter__(self):
+    """Iterate over the source loan dicts in batch order"""
+    return itertools.imap(self.loans.__getitem__, self.index)
+
+  def column(self, name):
+    """
+    Return the values of column `name` for the selected rows.
+    Columns are 'id', 'intRate', 'subGrade' (as rank) and 'term'.
+    """
+    full = self._full
+
+    col = self._columns.get(name)
+    if col is not None:
+      return col if full else map(col.__getitem__, self.index)
+
+    typecode, convert = _COLUMNS[name]
+    rows = self.loans if full else map(self.loans.__getitem__, self.index)
+    values = map(operator.itemgetter(name), rows)
+    if convert is not None:
+      values = map(convert, values)
+
+    # Only whole columns are kept; they are shared by every selection
+    if full:
+      values = self._columns[name] = array(typecode, values)
+    return values
+
+  @property
+  def ids(self):
+    """Loan ids of the selected rows"""
+    return self.column('id')
+
+  def _select(self, index, full=False):
+    return LoanBatch(self.loans, self._columns, index, full)
+
+  def compress(self, mask):
+    """Return the loans where `mask` is true"""
+    index = list(itertools.compress(self.index, mask))
+    # Compressing keeps the order, so dropping nothing keeps it whole
+    return self._select(index, self._full and len(index) == len(self.index))
+
+  def mask(self, min_rate=None, max_rate=None, min_sub_grade=None,
+           max_sub_grade=None, terms=None):
+    """
+    Return a list of booleans, true for loans meeting every criterion.
+    Criteria left as None are not applied. Sub-grades are given as
+    strings like 'B3' and compared by rank.
+    """
+    # partial(operator.le, x)(v) is x <= v
+    masks = []
+    if min_rate is not None:
+      masks.append(map(partial(operator.le, min_rate),
+                       self.column('intRate')))
+    if max_rate is not None:
+      masks.append(map(partial(operator.ge, max_rate),
+                       self.column('intRate')))
+    if min_sub_grade is not None:
+      masks.append(map(partial(operator.le, sub_grade_rank(min_sub_grade)),
+                       self.column('subGrade')))
+    if max_sub_grade is not None:
+      masks.append(map(partial(operator.ge, sub_grade_rank(max_sub_grade)),
+                       self.column('subGrade')))
+    if terms is not None:
+      masks.append(map(frozenset(terms).__contains__, self.column('term')))
+
+    if not masks:
+      return [True] * len(self)
+    return reduce(lambda a, b: map(operator.and_, a, b), masks)
+
+  def where(self, **criteria):
+    """Return the loans meeting `criteria` (see `mask`)"""
+    return self.compress(self.mask(**criteria))
+
+  def sort_by_rate(self, reverse=True):
+    """Return the batch ordered by interest rate, highest first by default"""
+    rates = self.column('intRate')
+    order = sorted(xrange(len(rates)), key=rates.__getitem__, reverse=reverse)
+    return self._select(map(self.index.__getitem__, order))
+
+  def join(self, loan_ids):
+    """Return the loans whose id is in the set `loan_ids`"""
+    return self.compress(map(loan_ids.__contains__, self.column('id')))
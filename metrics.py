@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+Lightweight instrumentation for the investment hot path: timing spans,
+counters, and exporters writing JSON lines or Prometheus text to a
+file or socket. Also provides `Lazy` for debug output that is only
+formatted if a handler actually emits it.
+"""
+
+import contextlib
+import json
+import os
+import re
+import socket
+import threading
+import time
+import urlparse
+
+import ratelimit
+
+__all__ = ['Metrics', 'Lazy', 'exporter_for']
+
+class Lazy:
+  """
+  Defer building a log message until it is emitted:
+    logger.debug('%s', Lazy(pprint.pformat, res))
+  pformat only runs if a handler accepts the debug record.
+  """
+  def __init__(self, fn, *args):
+    self.fn = fn
+    self.args = args
+
+  def __str__(self):
+    return str(self.fn(*self.args))
+
+
+class Metrics:
+  """
+  Thread-safe collector of timing spans and counters
+
+  Sources registered with `add_source` are sampled when a snapshot is
+  taken, so components like the connection pool keep their own counts
+  and cost nothing extra per request.
+  """
+  def __init__(self, clock=ratelimit.monotonic):
+    self.clock = clock
+    self._lock = threading.Lock()
+    self._sources = {}
+    self._gauges = set()
+    self.reset()
+
+  def reset(self):
+    """Drop recorded spans and counters"""
+    with self._lock:
+      self.spans = []
+      self.counters = {}
+
+  @contextlib.contextmanager
+  def span(self, name, **labels):
+    """Time the body of a `with` block as phase `name`"""
+    wall = time.time()
+    start = self.clock()
+    try:
+      yield
+    finally:
+      elapsed = self.clock() - start
+      with self._lock:
+        self.spans.append((name, wall, elapsed, labels))
+
+  def incr(self, name, value=1):
+    """Add `value` to counter `name`"""
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def add_source(self, name, fn, gauge=False):
+    """
+    Register `fn`, returning a dict of counter values, to be sampled
+    in every snapshot under the prefix `name`
+
+    gauge: The values are current readings that can go down, such as
+           an offset, rather than running totals
+    """
+    self._sources[name] = fn
+    if gauge:
+      self._gauges.add(name)
+
+  def snapshot(self):
+    """
+    Returns: dict with 'spans', a list of (name, start time, seconds,
+             labels), 'counters', a dict of counter values, and
+             'gauges', a dict of the values of gauge sources
+    """
+    with self._lock:
+      spans = list(self.spans)
+      counters = dict(self.counters)
+
+    gauges = {}
+    for prefix, fn in self._sources.items():
+      values = gauges if prefix in self._gauges else counters
+      for key, value in fn().items():
+        values['{}_{}'.format(prefix, key)] = value
+
+    return {'spans': spans, 'counters': counters, 'gauges': gauges}
+
+
+class _JsonLines:
+  """One JSON object per span, then one for the counters"""
+  def format(self, snapshot):
+    now = time.time()
+    lines = [json.dumps({'type': 'span', 'name': name, 'time': start,
+                         'seconds': seconds, 'labels': labels})
+             for name, start, seconds, labels in snapshot['spans']]
+    lines.append(json.dumps({'type': 'counters', 'time': now,
+                             'counters': snapshot['counters'],
+                             'gauges': snapshot.get('gauges', {})}))
+    return ''.join(line + '\n' for line in lines)
+
+
+class _Prometheus:
+  """Prometheus text exposition format"""
+  def _name(self, name):
+    return 'autoinvestor_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+  def format(self, snapshot):
+    # Phases repeat within a run (e.g. submit_order on every
+    # reattempt), so spans are summed per series
+    series = {}
+    for name, _, seconds, labels in snapshot['spans']:
+      labels = dict(labels, phase=name)
+      tags = ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+      total, count = series.get(tags, (0.0, 0))
+      series[tags] = (total + seconds, count + 1)
+
+    out = ['# TYPE autoinvestor_span_seconds summary']
+    for tags, (total, count) in sorted(series.items()):
+      out.append('autoinvestor_span_seconds_sum{{{}}} {}'.format(tags, total))
+      out.append('autoinvestor_span_seconds_count{{{}}} {}'.format(tags, count))
+
+    for kind in ('counter', 'gauge'):
+      for name, value in sorted(snapshot.get(kind + 's', {}).items()):
+        out.append('# TYPE {} {}'.format(self._name(name), kind))
+        out.append('{} {}'.format(self._name(name), value))
+    return '\n'.join(out) + '\n'
+
+
+class _FileExporter:
+  def __init__(self, path, formatter, append):
+    self.path = path
+    self.formatter = formatter
+    self.append = append
+
+  def export(self, snapshot):
+    text = self.formatter.format(snapshot)
+    if self.append:
+      with open(self.path, 'a') as f:
+        f.write(text)
+      return
+
+    # Replace atomically so a scraper never reads a partial file
+    tmp = self.path + '.tmp'
+    with open(tmp, 'w') as f:
+      f.write(text)
+    os.rename(tmp, self.path)
+
+
+class _SocketExporter:
+  def __init__(self, host, port, formatter):
+    self.address = (host, port)
+    self.formatter = formatter
+
+  def export(self, snapshot):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      for line in self.formatter.format(snapshot).splitlines():
+        sock.sendto(line, self.address)
+    finally:
+      sock.close()
+
+
+def exporter_for(target):
+  """
+  Return an exporter for `target`:
+    udp://host:port -- JSON lines sent as datagrams
+    *.prom -- Prometheus text file, rewritten on every export
+    anything else -- JSON lines appended to a file
+  Exporters have an `export(snapshot)` method.
+  """
+  if target.startswith('udp://'):
+    parts = urlparse.urlsplit(target)
+    return _SocketExporter(parts.hostname, parts.port, _JsonLines())
+  if target.endswith('.prom'):
+    return _FileExporter(target, _Prometheus(), append=False)
+  return _FileExporter(target, _JsonLines(), append=True)
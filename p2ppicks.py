@@ -9,7 +9,10 @@ import hashlib
 import json
 import pprint
 import urllib
-import urllib2
+
+import cache
+import hedge
+import transport
 
 __all__ = ['API']
 
@@ -19,14 +22,55 @@ class API:
   https://www.p2p-picks.com/
   """
 
-  _BASE_URL = "https://www.p2p-picks.com/api/v1/{method}/{action}"
+  # Root of all api methods
+  API_URL = "https://www.p2p-picks.com/api/v1"
+
+  # Headers of every request
+  _HEADERS = {'Content-type': 'application/x-www-form-urlencoded'}
+
+  # Seconds a subscriber's status is trusted for
+  STATUS_TTL = 3600.0
+
+  # Picks product used when none are given
+  DEFAULT_PRODUCT = 'profit-maximizer'
 
-  def __init__(self, key, secret, session_id):
+  # Subscriber statuses, shared by every API object of this process
+  _status_cache = cache.TTLCache()
+
+  def __init__(self, key, secret, session_id, pool=None, api_url=None,
+               products=None):
     """
     key: P2P-Picks API key
     secret: P2P-Picks API secret
     session_id: P2P-Picks session id for this user
+    pool: transport.ConnectionPool to send requests on.
+          Defaults to the pool shared by all API objects.
+    api_url: Root url of the api. Defaults to API_URL.
+    products: Picks products subscribed to, in order of preference.
+              Defaults to DEFAULT_PRODUCT.
     """
+    self.products = list(products or [API.DEFAULT_PRODUCT])
+
+    self._base_url = (api_url or API.API_URL) + '/{method}/{action}'
+
+    # Keep-alive connections to www.p2p-picks.com
+    self.pool = pool if pool is not None else transport.default_pool()
+
+    # Timing of the most recent request (see transport.Response)
+    self.last_timing = None
+
+    # Estimated offset of P2P-Picks' clock, learned from responses
+    self.clock = self.pool.clock(self._base_url)
+
+    # Signed requests with fixed parameters, and hashed signature prefixes
+    self._prepared = {}
+    self._sig_prefixes = {}
+
+    # Product -> (body, result) of its last picks response
+    self._picks = {}
+
+    # Backup requests for slow picks polls
+    self.hedger = hedge.Hedger()
 
     # Store secrets
     self.p2p_key = key
@@ -37,53 +81,106 @@ class API:
     if not self.isActive():
       raise Exception("P2P-Picks account not active")
 
-  def _request(self, method, action, data):
+  def _prepare(self, method, action, data, static=False):
     """
-    Request P2P-Picks REST endpoint
-    Returns: JSON response with meta data removed
+    Sign a request
+    Returns: (url, urlencoded body)
 
-    method: api method
-    action: api action
-    data: Dictionary of POST paramaters and values
+    static: `data` is the same on every call, so keep the result and
+            reuse it, e.g. for the picks poll
     """
+    key = (method, action, tuple(sorted(data.items())))
+    prepared = self._prepared.get(key)
+    if prepared is not None:
+      return prepared
 
     # This is required for every request
-    data['api_key'] = self.p2p_key
+    data = dict(data, api_key=self.p2p_key)
 
-    # Create signature from md5 hash of POST paramaters
-    md5 = hashlib.md5()
-    md5.update('{}-{}&'.format(method, action))
+    # Create signature from md5 hash of POST paramaters.
+    # The method and action prefix is hashed once and copied.
+    prefix = self._sig_prefixes.get((method, action))
+    if prefix is None:
+      prefix = hashlib.md5('{}-{}&'.format(method, action))
+      self._sig_prefixes[(method, action)] = prefix
+    md5 = prefix.copy()
 
-    for key in sorted(data):
-      md5.update('{}{}&'.format(key, data[key]))
+    for name in sorted(data):
+      md5.update('{}{}&'.format(name, data[name]))
 
     md5.update('secret{}'.format(self.p2p_secret))
     data['sig'] = md5.hexdigest()
 
-    # Send Request
-    req = urllib2.Request(
-      API._BASE_URL.format(method=method, action=action)
-    )
-    req.add_data(urllib.urlencode(data))
+    prepared = (self._base_url.format(method=method, action=action),
+                urllib.urlencode(data))
+    if static:
+      self._prepared[key] = prepared
+    return prepared
+
+  def _post(self, url, body):
+    """Send a prepared request. Returns: the response body"""
+    res = self.pool.request('POST', url, body, self._HEADERS)
+    self.last_timing = res.timing
+    return res.body
+
+  def _request(self, method, action, data, static=False):
+    """
+    Request P2P-Picks REST endpoint
+    Returns: JSON response with meta data removed
 
-    return json.load(urllib2.urlopen(req))['response']
+    method: api method
+    action: api action
+    data: Dictionary of POST paramaters and values
+    static: See _prepare
+    """
+    body = self._post(*self._prepare(method, action, data, static))
+    return json.loads(body)['response']
 
-  def picks(self):
+  def picks(self, product=None):
     """
-    List latests picks for P2P-Picks
+    List latests picks of a P2P-Picks product
+    product: Defaults to the first of `products`
     Returns a tuple of
       ([list of picks], timestamp)
+    While the picks don't change the same list is returned again,
+    so treat it as read-only.
 
-    A "pick" is a dictionary as follows
+    A "pick" is a dictionary as follows, tagged with its product
     {
       "grade": "D",
       "load_id": 29383729,
       "term": 36,
-      "top": "5%"
+      "top": "5%",
+      "product": "profit-maximizer"
     }
     """
-    data = self._request('picks', 'list', {'p2p_product': 'profit-maximizer'})
-    return data['picks'], dateparser.parse(data['timestamp'])
+    product = product or self.products[0]
+    url, data = self._picks_request(product)
+    body = self.hedger.call(lambda: self._post(url, data))
+
+    # Most polls see the same picks; skip decoding them again
+    last_body, result = self._picks.get(product, (None, None))
+    if body != last_body:
+      data = json.loads(body)['response']
+      for pick in data['picks']:
+        pick['product'] = product
+      result = data['picks'], dateparser.parse(data['timestamp'])
+      self._picks[product] = (body, result)
+    return result
+
+  def warm_up(self, connections=2):
+    """
+    Get ready to poll right before picks update: open connections and
+    sign the picks requests
+    """
+    self.pool.warm(self._base_url, connections)
+    for product in self.products:
+      self._picks_request(product)
+
+  def _picks_request(self, product):
+    """Returns: the signed (url, body) of the picks poll of `product`"""
+    return self._prepare('picks', 'list', {'p2p_product': product},
+                         static=True)
 
   def validate(self, email, password):
     """
@@ -100,40 +197,53 @@ class API:
 
     return str(data['sid']), str(data['status'])
 
-  def isActive(self):
-    """ Return True if user has picks activated """
-    data =self._request('subscriber', 'status', {'p2p_sid': self.p2p_sid})
+  def isActive(self, fresh=False):
+    """ Return True if user has picks activated
+    fresh: Ask P2P-Picks even if a recent status is cached
+    """
+    data = API._status_cache.get((self.p2p_key, self.p2p_sid),
+      lambda: self._request('subscriber', 'status', {'p2p_sid': self.p2p_sid},
+                            static=True),
+      self.STATUS_TTL, fresh)
     return data['status'] == 'active'
 
-  def report(self, res):
+  def reported_picks(self, res, product_of=None):
     """
-    Report P2P-Picks usage.
+    List the notes bought in an order, as reported to P2P-Picks
 
     res: the json response to lendingclub.API.submit_order()
+    product_of: Function returning the product that picked a loan id,
+                or None. Defaults to the first of `products`.
+    Returns: list of pick dicts, empty if nothing was invested
     """
     # Return if passed empty list
     if 'orderConfirmations' not in res:
-      return
+      return []
 
     # Return if no notes invested
     if res['orderInstructId'] is None:
-      return
+      return []
 
     orders = res['orderConfirmations']
 
+    def product(loan_id):
+      found = product_of(loan_id) if product_of is not None else None
+      return found or self.products[0]
+
     # Create  list of successful orders
-    picks = [{
-      'product': 'profit-maximizer',
+    return [{
+      'product': product(int(order['loanId'])),
       'loan_id': int(order['loanId']),
       'note': int(order['investedAmount'])
     } for order in orders if int(order['investedAmount'])]
 
-    # Build payload JSON object
-    p2p_payload = [{
-      'sid': self.p2p_sid,
-      'picks': picks
-    }]
+  def report_payload(self, p2p_payload):
+    """
+    Send a usage report
 
+    p2p_payload: list of {'sid': subscriber id, 'picks': [picks]}.
+                 Subscribers must share this API's key.
+    """
     data = {
       'p2p_payload': json.dumps(p2p_payload, separators=(',',':'))
     }
@@ -141,6 +251,23 @@ class API:
     # Report to P2P-Picks
     self._request('subscriber', 'report', data)
 
+  def report(self, res, product_of=None):
+    """
+    Report P2P-Picks usage.
+
+    res: the json response to lendingclub.API.submit_order()
+    product_of: See reported_picks
+    """
+    picks = self.reported_picks(res, product_of)
+    if not picks:
+      return
+
+    # Build payload JSON object
+    self.report_payload([{
+      'sid': self.p2p_sid,
+      'picks': picks
+    }])
+
 def main():
   # standard secrets file location
   with open('secrets.json') as f:
@@ -152,7 +279,8 @@ def main():
   # Initialize P2P-Picks API
   api = API(p2p_key, p2p_secret, p2p_sid)
 
-  pprint.pprint(api.picks())
+  for product in api.products:
+    pprint.pprint(api.picks(product))
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+Picks of several P2P-Picks products merged into one index keyed by
+loan id. Products are fetched concurrently, and a product whose picks
+did not change costs nothing to merge. The index is updated in place,
+so a poll only pays for the picks that changed, and looking loans up
+in it costs one dict lookup per loan.
+"""
+
+import asyncapi
+import transport
+
+__all__ = ['PickIndex']
+
+class PickIndex:
+  """
+  Tracks the picks of every subscribed product between polls
+
+  self.loans: dict of loan id -> {product: pick} for every picked loan
+  self.timestamps: dict of product -> time of its latest picks
+  self.version: Increases whenever any product's picks change
+  """
+  def __init__(self, api, products=None, executor=None):
+    """
+    api: p2ppicks.API instance
+    products: Products to track, in order of preference.
+              Defaults to the api's products.
+    executor: asyncapi.Executor to fetch on. Defaults to the shared one.
+    """
+    self.api = api
+    self.products = list(products or api.products)
+    self.executor = executor
+
+    self.loans = {}
+    self.timestamps = {}
+    self.version = 0
+
+    # Product -> the picks list last merged for it
+    self._lists = {}
+
+    # (version, list of every product's picks)
+    self._merged = (None, [])
+
+  def poll(self):
+    """
+    Fetch every product's picks and update the index
+    Returns: list of loan ids that no product picked before
+    """
+    if len(self.products) == 1:
+      results = [self.api.picks(self.products[0])]
+    else:
+      executor = self.executor or asyncapi.default_executor()
+      when = transport.current_deadline()
+      futures = [executor.submit(self._fetch, product, when)
+                 for product in self.products]
+      results = [future.result() for future in futures]
+
+    added = []
+    for product, (picks, timestamp) in zip(self.products, results):
+      self.timestamps[product] = timestamp
+      added.extend(loan_id for loan_id in self.apply(product, picks)
+                   if len(self.loans[loan_id]) == 1)
+    return added
+
+  def _fetch(self, product, when):
+    """Fetch the picks of `product` under the caller's deadline"""
+    if when is None:
+      return self.api.picks(product)
+    with transport.deadline(at=when):
+      return self.api.picks(product)
+
+  def apply(self, product, picks):
+    """
+    Replace the picks of `product`. Returns nothing new and costs
+    nothing if `picks` is the list merged last time, as p2ppicks.API
+    returns while picks don't change.
+    Returns: list of loan ids `product` didn't pick before
+    """
+    old = self._lists.get(product, ())
+    if old is picks:
+      return []
+    self._lists[product] = picks
+    self.version += 1
+
+    current = dict((int(pick['loan_id']), pick) for pick in picks)
+    for pick in old:
+      loan_id = int(pick['loan_id'])
+      if loan_id not in current:
+        entry = self.loans[loan_id]
+        del entry[product]
+        if not entry:
+          del self.loans[loan_id]
+
+    added = []
+    for loan_id, pick in current.iteritems():
+      entry = self.loans.setdefault(loan_id, {})
+      if product not in entry:
+        added.append(loan_id)
+      entry[product] = pick
+    return added
+
+  def updated_since(self, timestamps):
+    """True if any product has picks newer than in `timestamps`"""
+    for product, timestamp in self.timestamps.items():
+      before = timestamps.get(product)
+      if before is None or timestamp > before:
+        return True
+    return False
+
+  def picks(self):
+    """
+    Every product's picks in one list, products in order of
+    preference. The same list is returned until picks change, so
+    treat it as read-only.
+    """
+    version, merged = self._merged
+    if version != self.version:
+      merged = [pick for product in self.products
+                for pick in self._lists.get(product, ())]
+      self._merged = (self.version, merged)
+    return merged
+
+  def product(self, loan_id):
+    """The most preferred product that picked `loan_id`, or None"""
+    entry = self.loans.get(loan_id)
+    if entry:
+      for product in self.products:
+        if product in entry:
+          return product
+    return None
+
+  def join(self, loans):
+    """Loans of `loans` that some product picked, in the same order"""
+    return [loan for loan in loans if loan['id'] in self.loans]
+
+  def __contains__(self, loan_id):
+    return loan_id in self.loans
+
+  def __len__(self):
+    return len(self.loans)
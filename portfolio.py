@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+Local mirror of the notes an account owns. Syncs from
+notes_owned(detailed=True) with conditional requests, only rebuilds
+the notes that changed, and keeps exposure totals by grade, portfolio
+and status up to date so they can be read at listing time for free.
+"""
+
+import collections
+import json
+
+import transport
+
+__all__ = ['Note', 'NoteMirror']
+
+# Compact record of one note. Tuples have no per-instance dict.
+Note = collections.namedtuple('Note', [
+  'note_id', 'loan_id', 'grade', 'portfolio', 'status', 'exposure',
+])
+
+# Note fields aggregates can be grouped by
+_GROUPS = ('grade', 'portfolio', 'status')
+
+def _note(data):
+  """Build a Note from a detailednotes record"""
+  exposure = data.get('principalPending')
+  if exposure is None:
+    exposure = data.get('noteAmount', 0.0)
+  return Note(int(data['noteId']), int(data['loanId']), data.get('grade'),
+              data.get('portfolioName'), data.get('loanStatus'),
+              float(exposure))
+
+
+class NoteMirror:
+  """
+  Owned notes of one account
+
+  self.notes: dict of note id -> Note
+  self.unchanged: Number of syncs skipped because nothing changed
+  """
+  def __init__(self, api):
+    """
+    api: lendingclub.API of the account
+    """
+    self.api = api
+    self.notes = {}
+    self.unchanged = 0
+
+    self._fetch = transport.ConditionalFetch(
+      lambda headers: api.notes_owned_response(True, headers),
+      key='myNotes')
+
+    # group -> key -> [count, exposure]
+    self._totals = dict((group, {}) for group in _GROUPS)
+
+  def _count(self, note, sign):
+    for group in _GROUPS:
+      total = self._totals[group].setdefault(getattr(note, group), [0, 0.0])
+      total[0] += sign
+      total[1] += sign * note.exposure
+      if not total[0]:
+        del self._totals[group][getattr(note, group)]
+
+  def fetch(self):
+    """
+    Download owned notes if they changed since the last fetch
+    Returns: list of detailednotes records, or None if unchanged
+    """
+    res = self._fetch.fetch()
+    if res is None:
+      self.unchanged += 1
+      return None
+    return json.loads(res.body).get('myNotes') or []
+
+  def sync(self):
+    """
+    Fetch owned notes and apply the differences
+    Returns: (added, changed, removed) lists of Note. Removed and
+             changed notes are given as they were before the sync.
+    """
+    records = self.fetch()
+    if records is None:
+      return [], [], []
+    return self.apply(records)
+
+  def apply(self, records):
+    """
+    Replace the mirror with detailednotes `records`, touching only
+    the notes that differ
+    Returns: (added, changed, removed) as in sync()
+    """
+    added, changed = [], []
+    seen = set()
+    for data in records:
+      note = _note(data)
+      seen.add(note.note_id)
+
+      old = self.notes.get(note.note_id)
+      if old == note:
+        continue
+      if old is None:
+        added.append(note)
+      else:
+        changed.append(old)
+        self._count(old, -1)
+      self._count(note, 1)
+      self.notes[note.note_id] = note
+
+    removed = [note for note_id, note in self.notes.items()
+               if note_id not in seen]
+    for note in removed:
+      self._count(note, -1)
+      del self.notes[note.note_id]
+
+    return added, changed, removed
+
+  def exposure(self, by='grade'):
+    """
+    by: 'grade', 'portfolio' or 'status'
+    Returns: dict of value -> outstanding principal
+    """
+    return dict((key, total[1]) for key, total in self._totals[by].items())
+
+  def counts(self, by='grade'):
+    """Returns: dict of value -> number of notes"""
+    return dict((key, total[0]) for key, total in self._totals[by].items())
+
+  def total(self):
+    """Outstanding principal across all notes"""
+    return sum(total[1] for total in self._totals['grade'].values())
+
+  def share(self, key, by='grade'):
+    """Fraction of the total exposure in notes whose `by` is `key`"""
+    total = self.total()
+    if not total:
+      return 0.0
+    return self._totals[by].get(key, [0, 0.0])[1] / total
+
+  def loan_ids(self):
+    """Returns: frozenset of ids of loans we hold notes in"""
+    return frozenset(note.loan_id for note in self.notes.values())
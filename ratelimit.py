@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+Token-bucket rate limiters for the LendingClub API. Limiters are safe
+to share between threads, and `FileTokenBucket` can also be shared
+between processes on the same host that use the same api key.
+"""
+
+import ctypes
+import ctypes.util
+import fcntl
+import heapq
+import itertools
+import os
+import struct
+import threading
+import time
+
+__all__ = ['TokenBucket', 'FileTokenBucket', 'monotonic',
+           'PRIORITY_ORDER', 'PRIORITY_HIGH', 'PRIORITY_NORMAL', 'PRIORITY_LOW']
+
+# Lower values are served first when several callers are waiting
+PRIORITY_ORDER = 0   # Order submission
+PRIORITY_HIGH = 1    # Listing polls at drop time
+PRIORITY_NORMAL = 2
+PRIORITY_LOW = 3     # Background account queries
+
+def _monotonic_clock():
+  """
+  Return a clock function that never goes backwards. CLOCK_MONOTONIC
+  is system wide, so readings can be compared between processes.
+  Falls back to time.time where clock_gettime is unavailable.
+  """
+  class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+  try:
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'libc.so.6',
+                        use_errno=True)
+    clock_gettime = librt.clock_gettime
+  except (OSError, AttributeError):
+    return time.time
+
+  CLOCK_MONOTONIC = 1
+  clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+  def monotonic():
+    t = timespec()
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)):
+      raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+  return monotonic
+
+monotonic = _monotonic_clock()
+
+
+class _RateLimiter:
+  """
+  Base class handling the in-process waiting queue. Waiting callers
+  are served in priority order, then first come first served.
+  Subclasses implement `_take()` to consume a token from their storage.
+
+  wait_time: Total seconds callers have spent waiting
+  calls: Number of tokens handed out
+  """
+  def __init__(self, rate, burst, clock=monotonic):
+    """
+    rate: Tokens added per second
+    burst: Maximum tokens that can accumulate
+    clock: Function returning the current time in seconds
+    """
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self.clock = clock
+
+    self.wait_time = 0.0
+    self.calls = 0
+
+    self._cond = threading.Condition(threading.Lock())
+    self._waiters = []
+    self._counter = itertools.count()
+
+  def _refill(self, tokens, updated, now):
+    """Return the token count after refilling since `updated`"""
+    return min(self.burst, tokens + (now - updated) * self.rate)
+
+  def _take(self):
+    """
+    Try to consume one token.
+    Returns: 0 if a token was consumed, else seconds until one is available
+    """
+    raise NotImplementedError
+
+  def acquire(self, priority=PRIORITY_NORMAL):
+    """
+    Block until a token is available for a caller of `priority`
+    Returns: seconds spent waiting
+    """
+    start = self.clock()
+    ticket = (priority, next(self._counter))
+
+    with self._cond:
+      heapq.heappush(self._waiters, ticket)
+      try:
+        while True:
+          if self._waiters[0] == ticket:
+            wait = self._take()
+            if wait <= 0:
+              break
+          else:
+            wait = None
+
+          # Bounded so KeyboardInterrupt is still delivered on Python 2
+          self._cond.wait(min(wait, 1.0) if wait is not None else 1.0)
+      finally:
+        self._waiters.remove(ticket)
+        heapq.heapify(self._waiters)
+        self._cond.notify_all()
+
+      waited = self.clock() - start
+      self.wait_time += waited
+      self.calls += 1
+      return waited
+
+  def try_acquire(self, priority=PRIORITY_NORMAL):
+    """
+    Take a token only if one is free right now and no caller of the
+    same or a more urgent priority is waiting for it
+    Returns: True if a token was taken
+    """
+    with self._cond:
+      if self._waiters and self._waiters[0][0] <= priority:
+        return False
+      if self._take() > 0:
+        return False
+      self.calls += 1
+      return True
+
+
+class TokenBucket(_RateLimiter):
+  """Rate limiter shared by the threads of a single process"""
+
+  def __init__(self, rate, burst=1, clock=monotonic):
+    _RateLimiter.__init__(self, rate, burst, clock)
+    self._tokens = self.burst
+    self._updated = self.clock()
+
+  def _take(self):
+    now = self.clock()
+    self._tokens = self._refill(self._tokens, self._updated, now)
+    self._updated = now
+
+    if self._tokens >= 1.0:
+      self._tokens -= 1.0
+      return 0
+    return (1.0 - self._tokens) / self.rate
+
+
+class FileTokenBucket(_RateLimiter):
+  """
+  Rate limiter whose bucket lives in a lock file so every process on
+  the host using the same file shares one budget. Priorities are
+  honoured between the threads of one process; between processes
+  tokens go to whichever caller asks first.
+  """
+  _STATE = struct.Struct('dd')
+
+  def __init__(self, path, rate, burst=1, clock=monotonic):
+    """
+    path: File holding the shared bucket state. Created if missing.
+    """
+    _RateLimiter.__init__(self, rate, burst, clock)
+    self.path = path
+    self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+  def _take(self):
+    fcntl.flock(self._fd, fcntl.LOCK_EX)
+    try:
+      now = self.clock()
+      os.lseek(self._fd, 0, os.SEEK_SET)
+      raw = os.read(self._fd, self._STATE.size)
+
+      if len(raw) == self._STATE.size:
+        tokens, updated = self._STATE.unpack(raw)
+        tokens = self._refill(tokens, updated, now)
+      else:
+        tokens = self.burst
+
+      if tokens >= 1.0:
+        tokens -= 1.0
+        wait = 0
+      else:
+        wait = (1.0 - tokens) / self.rate
+
+      os.lseek(self._fd, 0, os.SEEK_SET)
+      os.write(self._fd, self._STATE.pack(tokens, now))
+      return wait
+    finally:
+      fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+  def close(self):
+    os.close(self._fd)
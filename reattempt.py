@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Bookkeeping for reattempting an order. Tracks requested and invested
+amounts per loan across order responses, so partial fills are topped
+up, loans that left the listing are dropped, and remaining cash goes
+to the best-ranked loans first.
+"""
+
+import criteria
+
+__all__ = ['OrderBook', 'GONE_STATUSES']
+
+# executionStatus values meaning the loan can no longer be ordered
+GONE_STATUSES = frozenset([
+  'NOT_AN_IN_FUNDING_LOAN',
+  'NOT_A_VALID_INVESTMENT',
+  'NOTE_DOES_NOT_EXIST',
+  'NOTE_NOT_AVAILABLE',
+  'INELIGIBLE_LOAN',
+  'LOAN_FULLY_FUNDED',
+])
+
+class OrderBook:
+  """
+  Requested and invested amounts of the loans in an order
+
+  Loans are ranked in the order they first appear in a response, which
+  is the order plan_orders ranked them in.
+  """
+  def __init__(self):
+    # loan_id -> [rank, requested, invested]
+    self._loans = {}
+    self._gone = set()
+
+  def update(self, res):
+    """
+    Record an order response
+    Returns: amount newly invested
+    """
+    invested = 0.0
+    for order in res.get('orderConfirmations', []):
+      loan_id = int(order['loanId'])
+      amount = float(order['investedAmount'])
+      invested += amount
+
+      loan = self._loans.get(loan_id)
+      if loan is None:
+        self._loans[loan_id] = [len(self._loans),
+                                float(order['requestedAmount']), amount]
+      else:
+        loan[2] += amount
+
+      if GONE_STATUSES.intersection(order.get('executionStatus', [])):
+        self._gone.add(loan_id)
+    return invested
+
+  def shortfall(self, loan_id):
+    """Amount of `loan_id` still to invest, in multiples of $25"""
+    _, requested, invested = self._loans[loan_id]
+    missing = requested - invested
+    return missing - missing % criteria.MIN_AMOUNT_PER_LOAN
+
+  def candidates(self):
+    """Loan ids still worth ordering, best-ranked first"""
+    open_loans = [(loan[0], loan_id) for loan_id, loan in self._loans.items()
+                  if loan_id not in self._gone and self.shortfall(loan_id) > 0]
+    return [loan_id for _, loan_id in sorted(open_loans)]
+
+  def done(self):
+    """True once every loan is fully funded or gone"""
+    return not self.candidates()
+
+  def next_order(self, cash):
+    """
+    Spread `cash` over the shortfalls of the best-ranked loans.
+    A loan gets part of its shortfall if that is all the cash left.
+
+    Returns: list of (loan_id, amount) pairs
+    """
+    order = []
+    for loan_id in self.candidates():
+      amount = min(self.shortfall(loan_id), cash)
+      amount -= amount % criteria.MIN_AMOUNT_PER_LOAN
+      if amount < criteria.MIN_AMOUNT_PER_LOAN:
+        break
+      order.append((loan_id, amount))
+      cash -= amount
+    return order
+
+  def totals(self):
+    """Returns: (requested, invested) over every loan"""
+    return (sum(loan[1] for loan in self._loans.values()),
+            sum(loan[2] for loan in self._loans.values()))
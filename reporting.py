@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+"""
+Background queue for work that must not delay orders: P2P-Picks usage
+reports and result logging. Reports are spooled to disk before they
+are queued, batched into one p2p_payload per api key, retried with
+backoff, and resent on the next start if the process exits first.
+"""
+
+import Queue
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib2
+import uuid
+
+__all__ = ['ReportQueue']
+
+class ReportQueue:
+  """
+  Sends P2P-Picks reports and runs deferred calls on a worker thread
+
+  self.sent: Number of reports delivered
+  self.failed: Number of reports given up on for now. They stay in the
+               spool and are resent by `retry()` or on the next start.
+  """
+  def __init__(self, spool=None, batch_window=0.25, max_attempts=5,
+               base_backoff=1.0, logger=None):
+    """
+    spool: Path to a file of unsent reports (one json object per line).
+           Without it reports only live in memory.
+    batch_window: Seconds to collect reports before sending them together
+    max_attempts: Attempts per batch before leaving it in the spool
+    base_backoff: First retry delay in seconds, doubled on each retry
+    logger: Logger for failures. Defaults to the AutoInvestor logger.
+    """
+    self.spool = spool
+    self.batch_window = batch_window
+    self.max_attempts = max_attempts
+    self.base_backoff = base_backoff
+    self.logger = logger or logging.getLogger('AutoInvestor')
+
+    self.sent = 0
+    self.failed = 0
+
+    # p2p_sid -> p2ppicks.API that reports for it
+    self._apis = {}
+
+    # Unsent reports by id, mirrored in the spool
+    self._spool_lock = threading.Lock()
+    self._pending = dict((entry['id'], entry) for entry in self._load())
+
+    self._queue = Queue.Queue()
+    self._thread = threading.Thread(target=self._run, name='reports')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _load(self):
+    if self.spool is None or not os.path.exists(self.spool):
+      return []
+    entries = []
+    with open(self.spool) as f:
+      for line in f:
+        try:
+          entries.append(json.loads(line))
+        except ValueError:
+          # A line cut short by a crash mid-write
+          continue
+    return entries
+
+  def register(self, api):
+    """
+    Report through `api` for its subscriber, and resend anything
+    spooled for that subscriber by an earlier run
+    """
+    self._apis[api.p2p_sid] = api
+    with self._spool_lock:
+      spooled = [e for e in self._pending.values() if e['sid'] == api.p2p_sid]
+    for entry in spooled:
+      self._queue.put(('report', entry))
+
+  def report(self, api, res, product_of=None):
+    """
+    Queue a report of the notes bought in `res`
+
+    api: p2ppicks.API of the subscriber that placed the order
+    res: the json response to lendingclub.API.submit_order()
+    product_of: Function returning the product that picked a loan id
+                (see p2ppicks.API.reported_picks)
+    """
+    picks = api.reported_picks(res, product_of)
+    if not picks:
+      return
+
+    entry = {'id': uuid.uuid4().hex, 'sid': api.p2p_sid, 'picks': picks}
+    self._apis.setdefault(api.p2p_sid, api)
+
+    # Written before queueing so an exit can't lose it
+    with self._spool_lock:
+      self._pending[entry['id']] = entry
+      if self.spool is not None:
+        try:
+          with open(self.spool, 'a') as f:
+            f.write(json.dumps(entry, separators=(',',':')) + '\n')
+        except (IOError, OSError) as err:
+          # Still sent from memory; only a crash before then loses it
+          self.logger.error("Could not spool report: {}".format(err))
+
+    self._queue.put(('report', entry))
+
+  def retry(self):
+    """
+    Queue every undelivered report again, e.g. at the start of each
+    run of a long-lived process
+    Returns: number of reports queued
+    """
+    with self._spool_lock:
+      pending = [e for e in self._pending.values() if e['sid'] in self._apis]
+    for entry in pending:
+      self._queue.put(('report', entry))
+    return len(pending)
+
+  def defer(self, fn, *args):
+    """Call fn(*args) on the worker thread, e.g. to log results"""
+    self._queue.put(('call', fn, args))
+
+  def flush(self, timeout=None):
+    """
+    Wait until everything queued so far is handled
+    Returns: True if the queue drained before `timeout` seconds
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while self._queue.unfinished_tasks:
+      if deadline is not None and time.time() >= deadline:
+        return False
+      time.sleep(0.05)
+    return True
+
+  def _run(self):
+    while True:
+      items = [self._queue.get()]
+
+      # Collect whatever else arrives in the batch window
+      deadline = time.time() + self.batch_window
+      while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        try:
+          items.append(self._queue.get(timeout=remaining))
+        except Queue.Empty:
+          break
+
+      # This is the only worker; nothing may stop it
+      try:
+        reports = []
+        for item in items:
+          if item[0] == 'call':
+            self._call(item[1], item[2])
+          else:
+            reports.append(item[1])
+
+        if reports:
+          self._send(reports)
+      except Exception as err:
+        self.logger.error("Report worker error: {} {}".format(type(err), err))
+      finally:
+        for _ in items:
+          self._queue.task_done()
+
+  def _call(self, fn, args):
+    try:
+      fn(*args)
+    except Exception as err:
+      self.logger.error("Deferred call failed: {} {}".format(type(err), err))
+
+  def _send(self, entries):
+    """Send `entries` as one request per api key"""
+    batches = {}
+    seen = set()
+    for entry in entries:
+      with self._spool_lock:
+        if entry['id'] not in self._pending or entry['id'] in seen:
+          # Already sent or in this batch, e.g. queued again by retry()
+          continue
+        seen.add(entry['id'])
+      api = self._apis.get(entry['sid'])
+      if api is None:
+        continue
+      batches.setdefault(api.p2p_key, (api, []))[1].append(entry)
+
+    for api, batch in batches.values():
+      # One p2p_payload entry per subscriber
+      picks = {}
+      for entry in batch:
+        picks.setdefault(entry['sid'], []).extend(entry['picks'])
+      payload = [{'sid': sid, 'picks': p} for sid, p in sorted(picks.items())]
+
+      if self._attempt(api, payload):
+        self.sent += len(batch)
+        self._remove(batch)
+      else:
+        self.failed += len(batch)
+        self.logger.error("Giving up on {} P2P-Picks reports for now"
+                          .format(len(batch)))
+
+  def _attempt(self, api, payload):
+    """Try to send `payload`, backing off between attempts"""
+    for attempt in range(self.max_attempts):
+      try:
+        api.report_payload(payload)
+        return True
+      except urllib2.HTTPError as err:
+        self.logger.error("Report HTTPError: {}".format(err.code))
+      except urllib2.URLError as err:
+        self.logger.error("Report URLError: {}".format(err.reason))
+      except Exception as err:
+        self.logger.error("Report failed: {} {}".format(type(err), err))
+
+      if attempt + 1 < self.max_attempts:
+        time.sleep(random.uniform(0.5, 1.0) * self.base_backoff * 2 ** attempt)
+    return False
+
+  def _remove(self, batch):
+    """Drop delivered reports from the spool"""
+    with self._spool_lock:
+      for entry in batch:
+        self._pending.pop(entry['id'], None)
+
+      if self.spool is None:
+        return
+      tmp = self.spool + '.tmp'
+      try:
+        with open(tmp, 'w') as f:
+          for entry in self._pending.values():
+            f.write(json.dumps(entry, separators=(',',':')) + '\n')
+        os.rename(tmp, self.spool)
+      except (IOError, OSError) as err:
+        # Delivered reports stay spooled and are resent on the next start
+        self.logger.error("Could not update report spool: {}".format(err))
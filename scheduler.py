@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+Adaptive polling schedule for listing drops. Learns when new data
+usually appears relative to the top of the hour, polls slowly until
+shortly before that moment and as fast as allowed around it, and
+backs off with jitter after errors. Also knows when LendingClub's
+listing windows are.
+"""
+
+import datetime as dt
+import json
+import os
+import random
+import threading
+import time
+
+from dateutil import tz
+
+__all__ = ['PollScheduler', 'next_listing', 'sleep_until',
+           'LISTING_HOURS', 'LISTING_TZ']
+
+# LendingClub lists new loans at these hours, Pacific time
+LISTING_TZ = tz.gettz('America/Los_Angeles')
+LISTING_HOURS = (6, 10, 14, 18)
+
+def next_listing(now=None):
+  """
+  Return the first listing window after `now` as a timezone-aware
+  datetime. Daylight saving changes are handled by LISTING_TZ.
+
+  now: aware datetime. Defaults to the current time.
+  """
+  now = dt.datetime.now(LISTING_TZ) if now is None \
+        else now.astimezone(LISTING_TZ)
+
+  for days in range(2):
+    day = now.date() + dt.timedelta(days=days)
+    for hour in LISTING_HOURS:
+      listing = dt.datetime(day.year, day.month, day.day, hour,
+                            tzinfo=LISTING_TZ)
+      if listing > now:
+        return listing
+
+def sleep_until(when):
+  """
+  Sleep until the aware datetime `when`. Sleeps in short steps so a
+  suspended host or a clock adjustment doesn't make us oversleep.
+  """
+  while True:
+    remaining = (when - dt.datetime.now(LISTING_TZ)).total_seconds()
+    if remaining <= 0:
+      return
+    time.sleep(min(remaining, 60.0))
+
+class PollScheduler:
+  """
+  Schedules the polls of one data source
+
+  self.requests: Number of polls made in the current run
+  self.drop_offset: Seconds after the hour the current run saw new data,
+                    or None
+  """
+  # Drops recorded per source in the history file
+  HISTORY_SIZE = 50
+
+  # Drops further than this from the hour are not listing drops
+  # (e.g. a manual run mid-hour) and are not learned from
+  MAX_OFFSET = 120.0
+
+  # Serializes read-modify-write of the shared history file
+  _history_lock = threading.Lock()
+
+  def __init__(self, name, history=None, window=3.0, slow_interval=2.0,
+               base_backoff=0.25, max_backoff=8.0, clock=time.time):
+    """
+    name: Data source name, e.g. 'loans'. Keys the history file.
+    history: Path to a json file of past drop times shared by
+             schedulers. Without it drops are only remembered in memory.
+    window: Seconds before the expected drop to start polling at full speed
+    slow_interval: Seconds between polls before the window
+    base_backoff: First backoff delay after an error
+    max_backoff: Cap on the backoff delay
+    clock: Function returning the time in seconds. Pass the source's
+           clocksync.ClockSync.now to learn drops in server time.
+    """
+    self.name = name
+    self.history = history
+    self.window = window
+    self.slow_interval = slow_interval
+    self.base_backoff = base_backoff
+    self.max_backoff = max_backoff
+    self.clock = clock
+
+    self.offsets = self._load().get(name, [])
+    self.requests = 0
+    self.drop_offset = None
+    self._failures = 0
+    self._hour = None
+
+  def _load(self):
+    if self.history is None or not os.path.exists(self.history):
+      return {}
+    try:
+      with open(self.history) as f:
+        return json.load(f)
+    except ValueError:
+      return {}
+
+  def expected_drop(self):
+    """
+    Median seconds after the hour at which new data appeared in past
+    runs, or None if there is no history
+    """
+    if not self.offsets:
+      return None
+    ordered = sorted(self.offsets)
+    return ordered[len(ordered) // 2]
+
+  def start(self, now=None):
+    """Begin a run for the listing nearest to `now`"""
+    now = self.clock() if now is None else now
+
+    # Nearest top of the hour; polling starts a few seconds before it
+    self._hour = round(now / 3600.0) * 3600.0
+    self.requests = 0
+    self.drop_offset = None
+    self._failures = 0
+
+  def window_start(self):
+    """
+    Time polling at full speed starts in the current run, or None
+    if there is no history and every poll is made at full speed
+    """
+    if self._hour is None:
+      return None
+    return self.first_poll(self._hour)
+
+  def first_poll(self, hour):
+    """
+    Time polling at full speed should start for the drop at `hour`,
+    or None if there is no history
+    """
+    expected = self.expected_drop()
+    if expected is None:
+      return None
+    return hour + expected - self.window
+
+  def next_delay(self, now=None):
+    """
+    Seconds to wait before the next poll. Zero inside the window
+    around the expected drop, where the rate limiter sets the pace.
+    """
+    now = self.clock() if now is None else now
+    if self._hour is None:
+      self.start(now)
+
+    window_start = self.window_start()
+    if window_start is None or now >= window_start:
+      return 0.0
+
+    # Jitter keeps several pollers from moving in lockstep
+    interval = self.slow_interval * random.uniform(0.8, 1.2)
+    return min(interval, window_start - now)
+
+  def polled(self):
+    """Record a successful poll"""
+    self.requests += 1
+    self._failures = 0
+
+  def failed(self):
+    """
+    Record a failed poll
+    Returns: seconds to back off, using exponential backoff with full jitter
+    """
+    self.requests += 1
+    self._failures += 1
+    cap = min(self.max_backoff, self.base_backoff * 2 ** (self._failures - 1))
+    return random.uniform(0, cap)
+
+  def record_drop(self, now=None):
+    """Record that new data appeared at `now` and save it to the history"""
+    now = self.clock() if now is None else now
+    if self._hour is None:
+      self.start(now)
+    self.drop_offset = now - self._hour
+
+    if abs(self.drop_offset) > self.MAX_OFFSET:
+      return
+
+    self.offsets = (self.offsets + [self.drop_offset])[-self.HISTORY_SIZE:]
+
+    if self.history is None:
+      return
+
+    with PollScheduler._history_lock:
+      data = self._load()
+      data[self.name] = (data.get(self.name, []) + [self.drop_offset])\
+                        [-self.HISTORY_SIZE:]
+      tmp = self.history + '.tmp'
+      with open(tmp, 'w') as f:
+        json.dump(data, f)
+      os.rename(tmp, self.history)
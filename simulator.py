@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+"""
+Local stand-in for the LendingClub and P2P-Picks APIs, for measuring
+the investor without touching live accounts. Serves the endpoints used
+by lendingclub.API and p2ppicks.API with configurable listing drops,
+latency, errors and rate limiting.
+
+Control endpoints:
+  POST /_sim/drop?at=<epoch seconds>  Schedule a listing drop
+  GET  /_sim/stats                    Request counts and order times
+  POST /_sim/reset                    Clear the stats
+"""
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import hashlib
+import json
+import random
+import threading
+import time
+import urlparse
+from optparse import OptionParser
+
+__all__ = ['Simulator', 'serve']
+
+_LC_PREFIX = '/api/investor/v1'
+_P2P_PREFIX = '/api/v1'
+
+_SUB_GRADES = ['{}{}'.format(g, n) for g in 'ABCDEFG' for n in range(1, 6)]
+
+def _isoformat(epoch):
+  """Format epoch seconds like LendingClub's listD"""
+  return time.strftime('%Y-%m-%dT%H:%M:%S.000-00:00', time.gmtime(epoch))
+
+
+class Simulator:
+  """
+  State of the simulated services
+
+  loans_per_drop: Loans listed at each drop
+  picks_per_drop: Loans of each drop that P2P-Picks selects
+  picks_delay: Seconds between a listing drop and the picks update
+  latency: Mean added response latency in seconds
+  error_rate: Fraction of requests answered with a 500
+  rate_limit: Minimum seconds between LendingClub calls per api key;
+              faster calls get a 429
+  cash: Starting available cash of every account
+  """
+  def __init__(self, loans_per_drop=50, picks_per_drop=10, picks_delay=1.0,
+               latency=0.0, error_rate=0.0, rate_limit=1.0, cash=1000.0,
+               seed=None):
+    self.loans_per_drop = loans_per_drop
+    self.picks_per_drop = picks_per_drop
+    self.picks_delay = picks_delay
+    self.latency = latency
+    self.error_rate = error_rate
+    self.rate_limit = rate_limit
+    self.start_cash = cash
+
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self._next_id = 10000000
+    self._next_note = 0
+    self._grades = {}
+    self._drops = []
+
+    # Loans and picks currently visible, and when picks last changed
+    self.loans = []
+    self.picks = []
+    self.picks_time = time.time()
+
+    # (time, picks) of the next picks update
+    self._pending_picks = None
+
+    self.cash = {}
+    self.notes = {}
+    self.reset()
+
+    # A listing so the first poll has something to compare against
+    self._list(time.time() - 4 * 3600)
+
+  def reset(self):
+    """Clear request counts and order history"""
+    with self._lock:
+      self.requests = {}
+      self.orders = []
+      self.drop_times = []
+      self.throttled = 0
+      self.errors = 0
+      self._last_call = {}
+
+  def stats(self):
+    with self._lock:
+      return {
+        'requests': dict(self.requests),
+        'orders': list(self.orders),
+        'drops': list(self.drop_times),
+        'throttled': self.throttled,
+        'errors': self.errors,
+      }
+
+  def schedule_drop(self, at):
+    """List a new batch of loans at epoch seconds `at`"""
+    with self._lock:
+      self._drops.append(at)
+      self._drops.sort()
+
+  def _list(self, when):
+    """Add a batch of loans listed at `when` and pick some of them"""
+    batch = []
+    for _ in range(self.loans_per_drop):
+      self._next_id += 1
+      batch.append({
+        'id': self._next_id,
+        'listD': _isoformat(when),
+        'intRate': round(self._random.uniform(5.0, 28.0), 2),
+        'subGrade': self._random.choice(_SUB_GRADES),
+        'term': self._random.choice([36, 60]),
+        'loanAmount': self._random.choice([5000, 10000, 20000]),
+      })
+    self.loans = batch + self.loans
+
+    chosen = self._random.sample(batch, min(self.picks_per_drop, len(batch)))
+    self._pending_picks = (when + self.picks_delay, [{
+      'loan_id': str(loan['id']),
+      'grade': loan['subGrade'][0],
+      'term': loan['term'],
+      'top': self._random.choice(['5%', '10%', '15%']),
+    } for loan in chosen])
+
+  def _advance(self, now):
+    """Apply any drops and picks updates due by `now`"""
+    while self._drops and self._drops[0] <= now:
+      when = self._drops.pop(0)
+      self.drop_times.append(when)
+      self._list(when)
+
+    if self._pending_picks is not None and self._pending_picks[0] <= now:
+      self.picks_time, self.picks = self._pending_picks
+      self._pending_picks = None
+
+  def handle(self, verb, path, query, headers, body):
+    """
+    Route one request
+    Returns: (status, extra headers, body)
+    """
+    now = time.time()
+    with self._lock:
+      self.requests[path] = self.requests.get(path, 0) + 1
+      self._advance(now)
+
+      if path.startswith(_LC_PREFIX):
+        key = headers.get('authorization')
+        last = self._last_call.get(key, 0)
+        if now - last < self.rate_limit * 0.9:
+          self.throttled += 1
+          return 429, {}, '{"errors":[{"message":"Too many requests"}]}'
+        self._last_call[key] = now
+
+      if self._random.random() < self.error_rate:
+        self.errors += 1
+        return 500, {}, '{}'
+
+      if path.startswith(_LC_PREFIX + '/loans/listing'):
+        return self._listing(query, headers)
+      if path.startswith(_LC_PREFIX + '/accounts/'):
+        return self._account(verb, path, headers, body, now)
+      if path.startswith(_P2P_PREFIX + '/'):
+        return self._p2p(path, body)
+    return 404, {}, '{}'
+
+  def _listing(self, query, headers):
+    show_all = query.get('showAll', ['false'])[0] == 'true'
+    loans = self.loans if show_all else \
+            [l for l in self.loans if l['listD'] == self.loans[0]['listD']]
+    # asOfDate changes on every response, so like LendingClub's the
+    # ETag only covers the loans, and asOfDate comes first
+    body = json.dumps(collections.OrderedDict([
+      ('asOfDate', _isoformat(time.time())), ('loans', loans)]))
+
+    etag = '"{}"'.format(hashlib.md5(json.dumps(loans)).hexdigest())
+    if headers.get('if-none-match') == etag:
+      return 304, {'ETag': etag}, ''
+    return 200, {'ETag': etag}, body
+
+  def _account(self, verb, path, headers, body, now):
+    parts = path[len(_LC_PREFIX + '/accounts/'):].split('/')
+    investor, resource = parts[0], parts[1] if len(parts) > 1 else ''
+    cash = self.cash.setdefault(investor, self.start_cash)
+    notes = self.notes.setdefault(investor, [])
+
+    if resource == 'availablecash':
+      return 200, {}, json.dumps({'investorId': investor, 'availableCash': cash})
+    if resource == 'summary':
+      return 200, {}, json.dumps({'investorId': investor, 'availableCash': cash,
+                                  'totalNotes': len(notes)})
+    if resource in ('notes', 'detailednotes'):
+      body = json.dumps({'myNotes': notes})
+      etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+      if headers.get('if-none-match') == etag:
+        return 304, {'ETag': etag}, ''
+      return 200, {'ETag': etag}, body
+    if resource == 'portfolios' and verb == 'GET':
+      return 200, {}, json.dumps({'myPortfolios': [
+        {'portfolioId': 1, 'portfolioName': 'Simulated'}]})
+    if resource == 'portfolios':
+      data = json.loads(body)
+      return 200, {}, json.dumps({'portfolioId': 2,
+                                  'portfolioName': data['portfolioName']})
+    if resource == 'orders':
+      return self._order(investor, json.loads(body), now)
+    return 404, {}, '{}'
+
+  def _order(self, investor, data, now):
+    listed = set(l['id'] for l in self.loans)
+    self._grades = dict((l['id'], l['subGrade'][0]) for l in self.loans)
+    confirmations = []
+    for order in data['orders']:
+      amount = float(order['requestedAmount'])
+      amount -= amount % 25
+      invested = amount if order['loanId'] in listed \
+                 and amount <= self.cash[investor] else 0.0
+      self.cash[investor] -= invested
+      if invested:
+        self._next_note += 1
+        self.notes[investor].append({
+          'noteId': self._next_note,
+          'loanId': order['loanId'],
+          'grade': self._grades.get(order['loanId']),
+          'loanStatus': 'In Funding',
+          'portfolioName': 'Simulated',
+          'noteAmount': invested,
+          'principalPending': invested,
+        })
+      confirmations.append({
+        'loanId': order['loanId'],
+        'requestedAmount': float(order['requestedAmount']),
+        'investedAmount': invested,
+        'executionStatus': ['ORDER_FULFILLED' if invested else 'NOT_AN_IN_FUNDING_LOAN'],
+      })
+
+    self.orders.append({'time': now, 'investor': investor,
+                        'loans': [o['loanId'] for o in data['orders']]})
+    return 200, {}, json.dumps({
+      'orderInstructId': len(self.orders),
+      'orderConfirmations': confirmations,
+    })
+
+  def _p2p(self, path, body):
+    method, action = path[len(_P2P_PREFIX) + 1:].split('/')[:2]
+    data = urlparse.parse_qs(body)
+
+    if (method, action) == ('picks', 'list'):
+      response = {'picks': self.picks, 'timestamp': _isoformat(self.picks_time)}
+    elif (method, action) == ('subscriber', 'status'):
+      response = {'status': 'active'}
+    elif (method, action) == ('subscriber', 'validate'):
+      response = {'sid': data.get('p2p_email', [''])[0], 'status': 'active'}
+    elif (method, action) == ('subscriber', 'report'):
+      response = {'status': 'ok'}
+    else:
+      return 404, {}, '{}'
+    return 200, {}, json.dumps({'status': 'success', 'response': response})
+
+  def delay(self):
+    """Latency to add to a response"""
+    if not self.latency:
+      return 0.0
+    return self._random.expovariate(1.0 / self.latency)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def _respond(self, verb):
+    sim = self.server.simulator
+    parts = urlparse.urlsplit(self.path)
+    length = int(self.headers.get('content-length', 0))
+    body = self.rfile.read(length) if length else ''
+
+    if parts.path.startswith('/_sim/'):
+      status, headers, data = self._control(sim, parts)
+    else:
+      headers = dict((k.lower(), v) for k, v in self.headers.items())
+      status, headers, data = sim.handle(verb, parts.path,
+                                         urlparse.parse_qs(parts.query),
+                                         headers, body)
+      time.sleep(sim.delay())
+
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    for key, value in headers.items():
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(data)
+
+  def _control(self, sim, parts):
+    query = urlparse.parse_qs(parts.query)
+    if parts.path == '/_sim/drop':
+      sim.schedule_drop(float(query['at'][0]))
+      return 200, {}, '{}'
+    if parts.path == '/_sim/stats':
+      return 200, {}, json.dumps(sim.stats())
+    if parts.path == '/_sim/reset':
+      sim.reset()
+      return 200, {}, '{}'
+    return 404, {}, '{}'
+
+  def do_GET(self):
+    self._respond('GET')
+
+  def do_POST(self):
+    self._respond('POST')
+
+  def log_message(self, format, *args):
+    pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+def serve(simulator, host='127.0.0.1', port=0):
+  """
+  Start serving `simulator` on a background thread
+  Returns: the server. Its base url is http://host:server.server_port
+  """
+  server = _Server((host, port), _Handler)
+  server.simulator = simulator
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def main():
+  parser = OptionParser()
+  parser.add_option('--port', type='int', dest='port', default=8080)
+  parser.add_option('--latency', type='float', dest='latency', default=0.0,
+    help="Mean added latency in seconds")
+  parser.add_option('--error-rate', type='float', dest='error_rate',
+    default=0.0, help="Fraction of requests answered with a 500")
+  parser.add_option('--rate-limit', type='float', dest='rate_limit',
+    default=1.0, help="Minimum seconds between LendingClub calls")
+  parser.add_option('--picks-delay', type='float', dest='picks_delay',
+    default=1.0, help="Seconds from listing drop to picks update")
+  parser.add_option('--cash', type='float', dest='cash', default=1000.0,
+    help="Starting cash of every account")
+  parser.add_option('--seed', type='int', dest='seed')
+  options, args = parser.parse_args()
+
+  sim = Simulator(latency=options.latency, error_rate=options.error_rate,
+                  rate_limit=options.rate_limit,
+                  picks_delay=options.picks_delay, cash=options.cash,
+                  seed=options.seed)
+  server = serve(sim, port=options.port)
+  print "Simulator listening on http://127.0.0.1:{}".format(server.server_port)
+
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""
+Local SQLite history of everything the investor sees: listings, picks,
+order responses and owned notes. Every snapshot is appended in one
+transaction, and indexed columns make history queries local and fast.
+The full records are kept as json next to the indexed columns.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+__all__ = ['Store']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+  id INTEGER PRIMARY KEY,
+  kind TEXT NOT NULL,
+  taken REAL NOT NULL,
+  account TEXT
+);
+CREATE TABLE IF NOT EXISTS listings (
+  snapshot INTEGER NOT NULL REFERENCES snapshots(id),
+  loan_id INTEGER NOT NULL,
+  listed TEXT,
+  int_rate REAL,
+  sub_grade TEXT,
+  term INTEGER,
+  data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS listings_loan ON listings(loan_id);
+CREATE INDEX IF NOT EXISTS listings_listed ON listings(listed);
+
+CREATE TABLE IF NOT EXISTS picks (
+  snapshot INTEGER NOT NULL REFERENCES snapshots(id),
+  loan_id INTEGER NOT NULL,
+  top TEXT,
+  grade TEXT,
+  data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS picks_loan ON picks(loan_id);
+CREATE INDEX IF NOT EXISTS picks_top ON picks(top, snapshot);
+
+CREATE TABLE IF NOT EXISTS orders (
+  snapshot INTEGER NOT NULL REFERENCES snapshots(id),
+  order_id INTEGER,
+  loan_id INTEGER NOT NULL,
+  requested REAL,
+  invested REAL,
+  status TEXT
+);
+CREATE INDEX IF NOT EXISTS orders_loan ON orders(loan_id);
+
+CREATE TABLE IF NOT EXISTS notes (
+  snapshot INTEGER NOT NULL REFERENCES snapshots(id),
+  loan_id INTEGER NOT NULL,
+  note_id INTEGER,
+  data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notes_loan ON notes(loan_id);
+"""
+
+def _dumps(record):
+  return json.dumps(record, separators=(',',':'))
+
+class Store:
+  """
+  Append-only store of API snapshots
+
+  Safe to share between threads; writes are serialized.
+  """
+  def __init__(self, path):
+    """
+    path: SQLite database file. Created if missing.
+    """
+    self.path = path
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.row_factory = sqlite3.Row
+
+    # WAL lets readers (e.g. a backtest) run while we append
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.executescript(_SCHEMA)
+
+  def close(self):
+    with self._lock:
+      self._db.close()
+
+  def _append(self, kind, account, sql, rows, taken=None):
+    """Insert a snapshot and its rows in one transaction"""
+    taken = time.time() if taken is None else taken
+    with self._lock:
+      with self._db:
+        snapshot = self._db.execute(
+          'INSERT INTO snapshots (kind, taken, account) VALUES (?, ?, ?)',
+          (kind, taken, account)).lastrowid
+        self._db.executemany(sql, ((snapshot,) + row for row in rows))
+    return snapshot
+
+  def add_listing(self, loans, taken=None):
+    """Append a listing from lendingclub.API.listed_loans"""
+    return self._append('listing', None,
+      'INSERT INTO listings VALUES (?, ?, ?, ?, ?, ?, ?)',
+      ((loan['id'], loan.get('listD'), loan.get('intRate'),
+        loan.get('subGrade'), loan.get('term'), _dumps(loan))
+       for loan in loans), taken)
+
+  def add_picks(self, picks, taken=None):
+    """Append picks from p2ppicks.API.picks"""
+    return self._append('picks', None,
+      'INSERT INTO picks VALUES (?, ?, ?, ?, ?)',
+      ((int(pick['loan_id']), pick.get('top'), pick.get('grade'),
+        _dumps(pick))
+       for pick in picks), taken)
+
+  def add_order(self, res, account=None, taken=None):
+    """Append the response of lendingclub.API.submit_order"""
+    order_id = res.get('orderInstructId')
+    return self._append('order', account,
+      'INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?)',
+      ((order_id, int(o['loanId']), o.get('requestedAmount'),
+        o.get('investedAmount'), ','.join(o.get('executionStatus', [])))
+       for o in res.get('orderConfirmations', [])), taken)
+
+  def add_notes(self, notes, account=None, taken=None):
+    """Append lendingclub.API.notes_owned"""
+    return self._append('notes', account,
+      'INSERT INTO notes VALUES (?, ?, ?, ?)',
+      ((note['loanId'], note.get('noteId'), _dumps(note))
+       for note in notes), taken)
+
+  #
+  # History queries
+  #
+
+  def _query(self, sql, args=()):
+    with self._lock:
+      return self._db.execute(sql, args).fetchall()
+
+  def _latest(self, kind, account=None):
+    """Id of the newest snapshot of `kind`, or None"""
+    sql = 'SELECT MAX(id) FROM snapshots WHERE kind = ?'
+    args = (kind,)
+    if account is not None:
+      sql += ' AND account = ?'
+      args += (account,)
+    return self._query(sql, args)[0][0]
+
+  def snapshots(self, kind, account=None):
+    """
+    kind: 'listing', 'picks', 'order' or 'notes'
+    Returns: list of (snapshot id, epoch seconds taken), oldest first
+    """
+    sql = 'SELECT id, taken FROM snapshots WHERE kind = ?'
+    args = (kind,)
+    if account is not None:
+      sql += ' AND account = ?'
+      args += (account,)
+    return [tuple(row) for row in self._query(sql + ' ORDER BY id', args)]
+
+  def snapshot(self, snapshot):
+    """Records of a listing, picks or notes snapshot, as recorded"""
+    kind = self._query('SELECT kind FROM snapshots WHERE id = ?',
+                       (snapshot,))[0][0]
+    table = {'listing': 'listings', 'picks': 'picks', 'notes': 'notes'}[kind]
+    return [json.loads(row['data']) for row in self._query(
+      'SELECT data FROM {} WHERE snapshot = ? ORDER BY rowid'.format(table),
+      (snapshot,))]
+
+  def listed(self, since=None, until=None):
+    """
+    Loans first listed between the listD strings `since` and `until`,
+    one record per loan: the first one recorded
+    """
+    # Rows are appended in snapshot order, so the lowest rowid of a
+    # loan is its first record
+    sql = 'SELECT data FROM listings WHERE rowid IN ' \
+          '(SELECT MIN(rowid) FROM listings GROUP BY loan_id)'
+    args = ()
+    if since is not None:
+      sql += ' AND listed >= ?'
+      args += (since,)
+    if until is not None:
+      sql += ' AND listed < ?'
+      args += (until,)
+    sql += ' ORDER BY listed, loan_id'
+    return [json.loads(row['data']) for row in self._query(sql, args)]
+
+  def picked(self, top=None, since=None):
+    """
+    Picks, optionally only of tier `top` (e.g. '5%') and taken after
+    epoch seconds `since`, one record per loan: the first that matches
+    """
+    where = ''
+    args = ()
+    if top is not None:
+      where += ' AND top = ?'
+      args += (top,)
+    if since is not None:
+      where += ' AND taken >= ?'
+      args += (since,)
+    sql = 'SELECT data FROM picks WHERE rowid IN ' \
+          '(SELECT MIN(picks.rowid) FROM picks JOIN snapshots ' \
+          'ON picks.snapshot = snapshots.id WHERE 1{} GROUP BY loan_id) ' \
+          'ORDER BY loan_id'.format(where)
+    return [json.loads(row['data']) for row in self._query(sql, args)]
+
+  def loan_history(self, loan_id):
+    """
+    Everything recorded about `loan_id`
+    Returns: dict with 'listing', 'picks' and 'orders'. 'listing' and
+             'picks' are the latest records or None, 'orders' is a list
+             of (taken, account, requested, invested, status)
+    """
+    listing = self._query('SELECT data FROM listings WHERE loan_id = ? '
+                          'ORDER BY snapshot DESC LIMIT 1', (loan_id,))
+    pick = self._query('SELECT data FROM picks WHERE loan_id = ? '
+                       'ORDER BY snapshot DESC LIMIT 1', (loan_id,))
+    orders = self._query(
+      'SELECT taken, account, requested, invested, status FROM orders '
+      'JOIN snapshots ON orders.snapshot = snapshots.id '
+      'WHERE loan_id = ? ORDER BY taken', (loan_id,))
+    return {
+      'listing': json.loads(listing[0]['data']) if listing else None,
+      'picks': json.loads(pick[0]['data']) if pick else None,
+      'orders': [tuple(row) for row in orders],
+    }
+
+  def invested(self, account=None, since=None):
+    """
+    Total invested per loan from recorded order responses
+    Returns: dict of loan_id -> amount
+    """
+    sql = 'SELECT loan_id, SUM(invested) FROM orders JOIN snapshots ' \
+          'ON orders.snapshot = snapshots.id WHERE invested > 0'
+    args = ()
+    if account is not None:
+      sql += ' AND account = ?'
+      args += (account,)
+    if since is not None:
+      sql += ' AND taken >= ?'
+      args += (since,)
+    sql += ' GROUP BY loan_id'
+    return dict((row[0], row[1]) for row in self._query(sql, args))
+
+  def notes(self, account=None):
+    """Notes of the latest notes snapshot (of `account`)"""
+    snapshot = self._latest('notes', account)
+    if snapshot is None:
+      return []
+    return [json.loads(row['data']) for row in self._query(
+      'SELECT data FROM notes WHERE snapshot = ?', (snapshot,))]
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import unittest
+
+import criteria
+from loanbatch import LoanBatch
+
+LOANS = [
+  {'id': 1, 'intRate': 10.0, 'subGrade': 'B1', 'term': 36},
+  {'id': 2, 'intRate': 20.0, 'subGrade': 'E1', 'term': 60},
+  {'id': 3, 'intRate': 15.0, 'subGrade': 'C1', 'term': 36},
+]
+
+PICKS = [{'loan_id': str(loan['id']), 'top': '5%'} for loan in LOANS]
+
+class LoanBatchTest(unittest.TestCase):
+  def test_sort_unfiltered(self):
+    batch = LoanBatch.from_loans(LOANS)
+    self.assertEqual(list(batch.sort_by_rate().ids), [2, 3, 1])
+    self.assertEqual(list(batch.sort_by_rate(reverse=False).ids), [1, 3, 2])
+
+  def test_sort_after_whole_column_cached(self):
+    batch = LoanBatch.from_loans(LOANS)
+    self.assertEqual(list(batch.ids), [1, 2, 3])
+    ordered = batch.sort_by_rate()
+    self.assertEqual(list(ordered.ids), [2, 3, 1])
+    self.assertEqual(list(ordered.column('term')), [60, 36, 36])
+
+  def test_filter_keeping_every_row(self):
+    batch = LoanBatch.from_loans(LOANS).where(min_rate=5.0)
+    self.assertEqual(list(batch.ids), [1, 2, 3])
+    self.assertEqual(list(batch.sort_by_rate().ids), [2, 3, 1])
+
+  def test_join_then_sort(self):
+    batch = LoanBatch.from_loans(LOANS).join(frozenset([1, 2]))
+    self.assertEqual(list(batch.sort_by_rate().ids), [2, 1])
+
+
+class StrategySelectTest(unittest.TestCase):
+  def test_max_loans_takes_highest_rate(self):
+    strategy = criteria.Strategy({'max_loans': 1})
+    batch = LoanBatch.from_loans(LOANS)
+    self.assertEqual(strategy.select(batch, PICKS), [2])
+
+  def test_max_loans_with_filters(self):
+    strategy = criteria.Strategy({
+      'filters': {'term': {'in': [36]}},
+      'max_loans': 1,
+    })
+    batch = LoanBatch.from_loans(LOANS)
+    self.assertEqual(strategy.select(batch, PICKS), [3])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+
+"""
+Shared HTTP transport for the LendingClub and P2P-Picks wrappers.
+Connections are kept alive per host so repeated polling only pays
+for the request round-trip, not a new TCP and TLS handshake.
+
+Requests made inside `with deadline(seconds):` fail with a URLError
+instead of blocking past the deadline, whichever API makes them.
+"""
+
+import contextlib
+import hashlib
+import httplib
+import select
+import socket
+import ssl
+import threading
+import time
+import urllib2
+import urlparse
+from StringIO import StringIO
+
+import clocksync
+
+__all__ = ['ConnectionPool', 'Response', 'StreamResponse', 'default_pool',
+           'deadline', 'current_deadline', 'DeadlineExceeded',
+           'RequestNotSent', 'ConditionalFetch', 'DEFAULT_TIMEOUT']
+
+# Socket timeout of the default pool, so no request blocks forever
+DEFAULT_TIMEOUT = 20.0
+
+# Per-thread deadline of the requests being made
+_local = threading.local()
+
+def current_deadline():
+  """Epoch seconds requests on this thread must finish by, or None"""
+  return getattr(_local, 'deadline', None)
+
+@contextlib.contextmanager
+def deadline(seconds=None, at=None):
+  """
+  Bound every request made in the `with` block on this thread.
+  Nested deadlines can only shorten the enclosing one.
+
+  seconds: Time allowed from now
+  at: Epoch seconds to finish by, instead of `seconds`
+  """
+  outer = current_deadline()
+  when = at if at is not None else time.time() + seconds
+  _local.deadline = when if outer is None else min(outer, when)
+  try:
+    yield
+  finally:
+    _local.deadline = outer
+
+class DeadlineExceeded(socket.timeout):
+  """The deadline passed before the request could be sent"""
+
+class RequestNotSent(urllib2.URLError):
+  """
+  The request failed before it could reach the server, so the server
+  certainly did not act on it and it is safe to send again
+  """
+
+class Response:
+  """
+  Result of a request made through a `ConnectionPool`
+
+  status: HTTP status code
+  reason: HTTP reason phrase
+  headers: dict of lower-case header names to values
+  body: raw response body
+  reused: True if the request was sent on an existing connection
+  timing: dict of seconds spent in each phase of the request
+    'connect' -- opening the connection (0.0 when reused)
+    'wait' -- sending the request until the status line arrived
+    'read' -- reading the response body
+    'total' -- the whole request
+  """
+  def __init__(self, status, reason, headers, body, reused, timing):
+    self.status = status
+    self.reason = reason
+    self.headers = headers
+    self.body = body
+    self.reused = reused
+    self.timing = timing
+
+  def __repr__(self):
+    return '<Response {} {:.1f}ms>'.format(self.status,
+                                           self.timing['total'] * 1000)
+
+
+class StreamResponse(Response):
+  """
+  Response whose body is read incrementally by iterating over it.
+  `body` is None. 'read' and 'total' timing are filled in once the
+  body has been consumed. The connection goes back to the pool only
+  if the whole body is read; stopping early closes it.
+  """
+  def __init__(self, pool, key, conn, res, reused, timing, chunk_size):
+    Response.__init__(self, res.status, res.reason,
+                      dict(res.getheaders()), None, reused, timing)
+    self._pool = pool
+    self._key = key
+    self._conn = conn
+    self._res = res
+    self._chunk_size = chunk_size
+
+  def __iter__(self):
+    start = time.time()
+    complete = False
+    try:
+      while True:
+        # The thread's deadline also bounds reading the body
+        if self._conn.sock is not None:
+          self._conn.sock.settimeout(self._pool._remaining())
+        chunk = self._res.read(self._chunk_size)
+        if not chunk:
+          break
+        yield chunk
+      complete = True
+    except (socket.error, httplib.HTTPException) as err:
+      raise urllib2.URLError(err)
+    finally:
+      if complete:
+        self._pool._finish(self._key, self._conn, self._res)
+      else:
+        self._conn.close()
+
+    self.timing['read'] = time.time() - start
+    self.timing['total'] = sum(self.timing[phase]
+                               for phase in ('connect', 'wait', 'read'))
+
+
+class ConditionalFetch:
+  """
+  Repeated fetches of one resource that only return it when it
+  changed. Sends the validators of the last response (If-None-Match,
+  If-Modified-Since), and since servers don't always honour them,
+  also compares a digest of the body with the last one.
+  """
+  def __init__(self, send, key=None):
+    """
+    send: Function of a dict of extra request headers, returning a
+          `Response`
+    key: Json key the part of the body that matters starts at. Only
+         the body from this key onward is compared, so fields before
+         it such as a timestamp don't count as changes.
+    """
+    self.send = send
+    self.key = key
+
+    self._etag = None
+    self._last_modified = None
+    self._fingerprint = None
+
+  def headers(self):
+    """Validators to send with the next request"""
+    headers = {}
+    if self._etag is not None:
+      headers['If-None-Match'] = self._etag
+    if self._last_modified is not None:
+      headers['If-Modified-Since'] = self._last_modified
+    return headers
+
+  def fetch(self):
+    """
+    Request the resource
+    Returns: the `Response`, or None if the resource is unchanged
+    """
+    res = self.send(self.headers())
+    if res.status == 304:
+      return None
+
+    self._etag = res.headers.get('etag', self._etag)
+    self._last_modified = res.headers.get('last-modified', self._last_modified)
+
+    start = 0
+    if self.key is not None:
+      start = max(res.body.find('"{}"'.format(self.key)), 0)
+    fingerprint = hashlib.sha1(res.body[start:]).digest()
+    if fingerprint == self._fingerprint:
+      return None
+    self._fingerprint = fingerprint
+    return res
+
+
+class ConnectionPool:
+  """
+  Thread-safe pool of keep-alive connections keyed by (scheme, host, port)
+
+  maxsize: Maximum number of idle connections kept per host. Extra
+           connections are closed when released.
+  max_idle: Seconds a connection may sit idle before it is treated
+            as stale and replaced.
+  timeout: Socket timeout in seconds for new connections
+
+  self.stats: Counts of 'requests', 'connects' (new connections),
+              'retries' (on a fresh connection after a stale one)
+              and 'errors' (network failures)
+
+  Every response's Date header feeds the ClockSync of its host
+  (see `clock`).
+  """
+  def __init__(self, maxsize=4, max_idle=60.0, timeout=None):
+    self.maxsize = maxsize
+    self.max_idle = max_idle
+    self.timeout = timeout
+
+    # (scheme, host, port) -> list of (connection, last used time)
+    self._idle = {}
+    self._lock = threading.Lock()
+
+    self.stats = {'requests': 0, 'connects': 0, 'retries': 0, 'errors': 0}
+
+    # host -> clocksync.ClockSync
+    self._clocks = {}
+
+  def _count(self, stat):
+    with self._lock:
+      self.stats[stat] += 1
+
+  def clock(self, url):
+    """clocksync.ClockSync of the host of `url`"""
+    host = urlparse.urlsplit(url).hostname
+    with self._lock:
+      if host not in self._clocks:
+        self._clocks[host] = clocksync.ClockSync()
+      return self._clocks[host]
+
+  def _key(self, url):
+    """Return pool key and request path for `url`"""
+    parts = urlparse.urlsplit(url)
+    scheme = parts.scheme or 'http'
+    port = parts.port or (443 if scheme == 'https' else 80)
+    path = parts.path or '/'
+    if parts.query:
+      path += '?' + parts.query
+    return (scheme, parts.hostname, port), path
+
+  def _remaining(self):
+    """
+    Socket timeout for the next blocking step: the pool's timeout,
+    cut short by the thread's deadline
+    """
+    when = current_deadline()
+    if when is None:
+      return self.timeout
+    remaining = when - time.time()
+    if remaining <= 0:
+      raise DeadlineExceeded('deadline exceeded')
+    return remaining if self.timeout is None else min(self.timeout, remaining)
+
+  def _new_connection(self, key):
+    scheme, host, port = key
+    cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+    conn = cls(host, port, timeout=self._remaining())
+    conn.connect()
+    self._count('connects')
+
+    # Requests are small and latency bound; don't let Nagle hold them
+    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return conn
+
+  def _is_stale(self, conn, last_used):
+    """
+    A pooled connection is stale if it has idled past `max_idle`, or
+    if the server closed it or sent something while it sat idle.
+    """
+    if time.time() - last_used > self.max_idle:
+      return True
+    if conn.sock is None:
+      return True
+    try:
+      readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+      return True
+    if not readable:
+      return False
+    if not isinstance(conn.sock, ssl.SSLSocket):
+      return True
+
+    # TLS 1.3 servers send session tickets after the handshake, so a
+    # connection opened by `warm` is readable before it is ever used.
+    # Reading consumes them; only EOF or application data means stale.
+    conn.sock.setblocking(False)
+    try:
+      conn.sock.recv(1)
+    except ssl.SSLWantReadError:
+      return False
+    except (ssl.SSLError, socket.error):
+      return True
+    finally:
+      conn.sock.settimeout(self.timeout)
+    return True
+
+  def _acquire(self, key):
+    """
+    Return (connection, reused) for `key`, reusing a live idle
+    connection if one is available
+    """
+    with self._lock:
+      idle = self._idle.get(key, [])
+      while idle:
+        conn, last_used = idle.pop()
+        if not self._is_stale(conn, last_used):
+          return conn, True
+        conn.close()
+    return self._new_connection(key), False
+
+  def _release(self, key, conn):
+    # Undo any deadline applied while the connection was in use
+    if conn.sock is not None:
+      conn.sock.settimeout(self.timeout)
+
+    with self._lock:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self.maxsize:
+        idle.append((conn, time.time()))
+        return
+    conn.close()
+
+  def _finish(self, key, conn, res):
+    """Return a connection whose response was fully read to the pool"""
+    if res.will_close:
+      conn.close()
+    else:
+      self._release(key, conn)
+
+  def _open(self, method, url, body, headers):
+    """
+    Send a request and read the status line and headers
+    Returns: tuple of (key, conn, res, reused, timing) where timing
+             holds the 'connect' and 'wait' phases
+    """
+    key, path = self._key(url)
+    headers = dict(headers or {})
+    self._count('requests')
+
+    # A reused socket may have been closed by the server between our
+    # staleness check and the send. That request never reached the
+    # server, so it is safe to retry once on a fresh connection.
+    # A timeout is different: the server may still act on the request.
+    for attempt in range(2):
+      start = time.time()
+      try:
+        conn, reused = self._acquire(key)
+      except (socket.error, httplib.HTTPException) as err:
+        self._count('errors')
+        raise RequestNotSent(err)
+      connected = time.time()
+
+      try:
+        if reused:
+          conn.sock.settimeout(self._remaining())
+        conn.request(method, path, body, headers)
+        res = conn.getresponse()
+      except (httplib.BadStatusLine, httplib.CannotSendRequest,
+              socket.error) as err:
+        conn.close()
+        stale = reused and not isinstance(err, socket.timeout)
+        if stale and not attempt:
+          self._count('retries')
+          continue
+        self._count('errors')
+        if stale or isinstance(err, DeadlineExceeded):
+          raise RequestNotSent(err)
+        raise urllib2.URLError(err)
+      except httplib.HTTPException as err:
+        conn.close()
+        self._count('errors')
+        raise urllib2.URLError(err)
+      break
+
+    received = time.time()
+    server_time = clocksync.parse_date(res.getheader('date'))
+    if server_time is not None:
+      self.clock(url).observe(connected, received, server_time)
+
+    timing = {
+      'connect': connected - start,
+      'wait': received - connected,
+    }
+    return key, conn, res, reused, timing
+
+  def _read(self, url, key, conn, res):
+    """Read the whole body, raising HTTPError for error statuses"""
+    try:
+      if conn.sock is not None:
+        conn.sock.settimeout(self._remaining())
+      data = res.read()
+    except (socket.error, httplib.HTTPException) as err:
+      conn.close()
+      raise urllib2.URLError(err)
+    self._finish(key, conn, res)
+
+    if res.status >= 400:
+      raise urllib2.HTTPError(url, res.status, res.reason,
+                              res.msg, StringIO(data))
+    return data
+
+  def request(self, method, url, body=None, headers=None):
+    """
+    Send a request and return a `Response`
+
+    Raises urllib2.HTTPError for 4xx/5xx responses and urllib2.URLError
+    for network failures, matching urllib2.urlopen so callers can
+    handle both the same way.
+    """
+    key, conn, res, reused, timing = self._open(method, url, body, headers)
+
+    start = time.time()
+    data = self._read(url, key, conn, res)
+    timing['read'] = time.time() - start
+    timing['total'] = timing['connect'] + timing['wait'] + timing['read']
+
+    return Response(res.status, res.reason,
+                    dict(res.getheaders()), data, reused, timing)
+
+  def stream(self, method, url, body=None, headers=None, chunk_size=16384):
+    """
+    Send a request and return a `StreamResponse` to read the body
+    in chunks of up to `chunk_size` bytes as it arrives.
+    Error statuses are raised as in `request`.
+    """
+    key, conn, res, reused, timing = self._open(method, url, body, headers)
+
+    if res.status >= 400:
+      self._read(url, key, conn, res)
+
+    return StreamResponse(self, key, conn, res, reused, timing, chunk_size)
+
+  def warm(self, url, count=1):
+    """
+    Make sure `count` live connections to the host of `url` are idle
+    in the pool, so the next requests skip the TCP and TLS handshakes.
+    Stale idle connections are replaced.
+    Returns: number of connections opened
+    """
+    key, _ = self._key(url)
+    conns = []
+    opened = 0
+    try:
+      for _ in range(min(count, self.maxsize)):
+        conn, reused = self._acquire(key)
+        conns.append(conn)
+        opened += not reused
+    except (socket.error, httplib.HTTPException) as err:
+      self._count('errors')
+      raise urllib2.URLError(err)
+    finally:
+      for conn in conns:
+        self._release(key, conn)
+    return opened
+
+  def close(self):
+    """Close all idle connections"""
+    with self._lock:
+      for idle in self._idle.values():
+        for conn, _ in idle:
+          conn.close()
+      self._idle.clear()
+
+
+_default_pool = None
+_default_lock = threading.Lock()
+
+def default_pool():
+  """Return the process-wide ConnectionPool shared by all API objects"""
+  global _default_pool
+  with _default_lock:
+    if _default_pool is None:
+      _default_pool = ConnectionPool(timeout=DEFAULT_TIMEOUT)
+    return _default_pool